@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the NetEase cdn, shared by the benchmarks
+"""
+
+import http.server
+import os
+import threading
+import time
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve server.payload with Range support, throttled to server.rate bytes/s per connection
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_payload(self, head):
+        payload = self.server.payload
+        start, end = 0, len(payload) - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            first, _, last = range_header.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = int(last) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(payload)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"bench"')
+        self.end_headers()
+        if head:
+            return
+        view = memoryview(payload)[start:end + 1]
+        block = 64 * 1024
+        begin = time.perf_counter()
+        for offset in range(0, len(view), block):
+            try:
+                self.wfile.write(view[offset:offset + block])
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if self.server.rate:
+                delay = begin + (offset + block) / self.server.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def do_GET(self):
+        self._send_payload(False)
+
+    def do_HEAD(self):
+        self._send_payload(True)
+
+
+def start_server(payload, rate=None, handler=FileHandler):
+    """
+    Start a threaded http server on a free local port
+    :param payload: bytes served for every path
+    :param rate: per connection bytes/s, None for unthrottled
+    :return: (server, base url)
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.payload = payload
+    server.rate = rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def random_payload(size):
+    return os.urandom(size)
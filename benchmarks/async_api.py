@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Song detail and lyric lookups through CloudApi one by one versus AsyncCloudApi
+all at once, against a local fake api that answers after a fixed latency.
+The fake server is reached as an http proxy for music.163.com.
+
+    python benchmarks/async_api.py [lookups] [latency_ms]
+"""
+
+import asyncio
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncm import config  # noqa: E402
+from ncm.api import CloudApi  # noqa: E402
+from ncm.async_api import AsyncCloudApi  # noqa: E402
+from ncm.ratelimit import RateLimiter  # noqa: E402
+from ncm.session import create_session  # noqa: E402
+
+# Measure the clients, not the rate limit
+UNLIMITED = {kind: (0, 1) for kind in config.RATE_LIMITS}
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, result):
+        time.sleep(self.server.latency)
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        ids = json.loads(unquote(urlparse(self.path).query.split('=', 1)[1]))
+        self._reply({'code': 200, 'songs': [{'id': song_id, 'name': 'song {}'.format(song_id)} for song_id in ids]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._reply({'code': 200, 'lrc': {'lyric': '[00:00.00] la la la'}, 'tlyric': {'lyric': None}})
+
+
+class FakeApiServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for every concurrent connection of the async client
+    request_queue_size = 256
+
+
+def _run_sync(lookups):
+    api = CloudApi(session=create_session(retries=0), rate_limiter=RateLimiter(UNLIMITED))
+    for song_id in range(lookups):
+        api.get_song(song_id)
+        api.get_song_lyrics(song_id)
+
+
+async def _run_async(lookups):
+    async with AsyncCloudApi(limit_per_host=100, rate_limiter=RateLimiter(UNLIMITED)) as api:
+        await asyncio.gather(*[api.get_song(song_id) for song_id in range(lookups)],
+                             *[api.get_song_lyrics(song_id) for song_id in range(lookups)])
+
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    server = FakeApiServer(('127.0.0.1', 0), FakeApiHandler)
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['HTTP_PROXY'] = 'http://127.0.0.1:{}'.format(server.server_port)
+    os.environ.pop('NO_PROXY', None)
+    os.environ.pop('no_proxy', None)
+
+    print('{} song + {} lyric lookups, {:.0f} ms latency'.format(lookups, lookups, latency * 1000))
+    begin = time.perf_counter()
+    _run_sync(lookups)
+    elapsed = time.perf_counter() - begin
+    print('CloudApi       {:6.2f}s, {:8.1f} lookups/s'.format(elapsed, lookups * 2 / elapsed))
+    begin = time.perf_counter()
+    asyncio.run(_run_async(lookups))
+    elapsed = time.perf_counter() - begin
+    print('AsyncCloudApi  {:6.2f}s, {:8.1f} lookups/s'.format(elapsed, lookups * 2 / elapsed))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Time per cover of the old file based path (write jpg, reopen, thumbnail,
+save back, read for embedding, delete) versus resize_img on bytes with
+JPEG draft decoding.
+
+    python benchmarks/cover_resize.py [edge_px] [rounds]
+"""
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncm.file_util import resize_img  # noqa: E402
+
+
+def _make_cover(edge):
+    img = Image.effect_mandelbrot((edge, edge), (-2, -1.5, 1, 1.5), 100).convert('RGB')
+    output = io.BytesIO()
+    img.save(output, 'JPEG', quality=95)
+    return output.getvalue()
+
+
+def _old_resize(data, folder, max_size=(640, 640), quality=90):
+    path = os.path.join(folder, 'cover_bench.jpg')
+    with open(path, 'wb') as f:
+        f.write(data)
+    img = Image.open(path)
+    if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        img = img.convert('RGB')
+        img.save(path, quality=quality)
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.remove(path)
+    return data
+
+
+def main():
+    edge = int(sys.argv[1]) if len(sys.argv) > 1 else 1920
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    data = _make_cover(edge)
+    print('{}x{} jpeg, {} KB, {} rounds'.format(edge, edge, len(data) // 1024, rounds))
+    with tempfile.TemporaryDirectory() as folder:
+        for name, resize in (('file + thumbnail', lambda: _old_resize(data, folder)),
+                             ('bytes + draft', lambda: resize_img(data))):
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                resized = resize()
+            elapsed = (time.perf_counter() - begin) * 1000 / rounds
+            print('{:18} {:7.2f} ms/cover, {} KB'.format(name, elapsed, len(resized) // 1024))
+
+
+if __name__ == '__main__':
+    main()
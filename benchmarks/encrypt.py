@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Encrypted requests per second for batched api payloads (song url lookups of
+100 ids, song details of 500 ids) with the previous str based encryption,
+RequestEncryptor with a fresh key per request, and with a reused key.
+
+    python benchmarks/encrypt.py [seconds]
+"""
+
+import base64
+import binascii
+import json
+import os
+import sys
+import time
+
+from Cryptodome.Cipher import AES
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncm.constants import modulus, nonce, pub_key  # noqa: E402
+from ncm.encrypt import RequestEncryptor  # noqa: E402
+
+
+def _old_aes_encrypt(text, sec_key):
+    pad = 16 - len(text) % 16
+    text = text + chr(pad) * pad
+    encryptor = AES.new(sec_key.encode('utf-8'), AES.MODE_CBC, b'0102030405060708')
+    cipher_text = encryptor.encrypt(text.encode('utf-8'))
+    return base64.b64encode(cipher_text).decode('utf-8')
+
+
+def _old_rsa_encrypt(text, public_key, p_modulus):
+    text = text[::-1]
+    rs = pow(int(binascii.hexlify(text), 16), int(public_key, 16), int(p_modulus, 16))
+    return format(rs, 'x').zfill(256)
+
+
+def _old_encrypted_request(text):
+    text = json.dumps(text)
+    sec_key = binascii.hexlify(os.urandom(16))[:16]
+    enc_text = _old_aes_encrypt(_old_aes_encrypt(text, nonce), sec_key.decode('utf-8'))
+    return {'params': enc_text, 'encSecKey': _old_rsa_encrypt(sec_key, pub_key, modulus)}
+
+
+def _rate(encrypt, params, seconds):
+    count = 0
+    begin = time.perf_counter()
+    while time.perf_counter() - begin < seconds:
+        encrypt(params)
+        count += 1
+    return count / (time.perf_counter() - begin)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    payloads = (
+        ('song urls x100', {'ids': list(range(1900000000, 1900000100)), 'br': 999000, 'csrf_token': ''}),
+        ('song detail x500', {'c': json.dumps([{'id': i} for i in range(1900000000, 1900000500)]),
+                              'csrf_token': ''}),
+    )
+    engines = (
+        ('previous', _old_encrypted_request),
+        ('fresh key', RequestEncryptor(0).encrypt),
+        ('reused key', RequestEncryptor(300).encrypt),
+    )
+    for payload_name, params in payloads:
+        for engine_name, encrypt in engines:
+            print('{:18} {:12} {:10.0f} req/s'.format(payload_name, engine_name, _rate(encrypt, params, seconds)))
+
+
+if __name__ == '__main__':
+    main()
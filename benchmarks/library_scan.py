@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Library index scans of a generated download tree (artist/album/track layout,
+half mp3 with ID3v2.3 tags, half flac, each with a small cover): a full scan
+reading every tag with mutagen, the same walk with the header-only reader,
+LibraryIndex full scans with 1 and N reader threads, a rescan with nothing
+changed and a rescan after touching 1% of the files. The page cache is warm
+after the tree is written, so this measures the parsing and syscalls, not the disk.
+
+    python benchmarks/library_scan.py [--files 50000] [--workers 8] [--cover-size 2048] [--keep DIR]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import APIC, ID3, TIT2, TPE1, TXXX
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncm.file_util import SONG_ID_TAG, _read_song_id_mutagen, read_song_id  # noqa: E402
+from ncm.library import LibraryIndex, _walk_audio_files  # noqa: E402
+
+# 10 digit placeholder id patched in the template bytes, ids stay 10 digits
+_PLACEHOLDER_ID = 1000000000
+_MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+def _flac_header():
+    # fLaC and a last STREAMINFO block: 4096 sample blocks, 44.1 kHz, stereo, 16 bits
+    stream_info = (4096).to_bytes(2, 'big') * 2 + b'\x00' * 6
+    stream_info += ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, 'big') + b'\x00' * 16
+    return b'fLaC' + b'\x80' + len(stream_info).to_bytes(3, 'big') + stream_info
+
+
+def _templates(folder, cover_size):
+    cover = os.urandom(cover_size)
+    mp3_path = os.path.join(folder, 'template.mp3')
+    with open(mp3_path, 'wb') as mp3_file:
+        mp3_file.write(_MP3_FRAME * 20)
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text='title'))
+    tags.add(TPE1(encoding=3, text='artist'))
+    tags.add(APIC(encoding=3, mime='image/jpeg', type=3, data=cover))
+    tags.add(TXXX(encoding=3, desc=SONG_ID_TAG, text=str(_PLACEHOLDER_ID)))
+    tags.save(mp3_path, v2_version=3, padding=lambda info: 1024)
+
+    flac_path = os.path.join(folder, 'template.flac')
+    with open(flac_path, 'wb') as flac_file:
+        flac_file.write(_flac_header() + b'\xff\xf8' + b'\x00' * 8190)
+    audio = FLAC(flac_path)
+    picture = Picture()
+    picture.type = 3
+    picture.mime = 'image/jpeg'
+    picture.data = cover
+    audio.add_picture(picture)
+    audio['title'] = 'title'
+    audio[SONG_ID_TAG.lower()] = str(_PLACEHOLDER_ID)
+    audio.save(padding=lambda info: 1024)
+
+    with open(mp3_path, 'rb') as mp3_file, open(flac_path, 'rb') as flac_file:
+        # ID3v2.3 has no utf-8, mutagen stores the text as utf-16
+        return ((mp3_file.read(), str(_PLACEHOLDER_ID).encode('utf-16-le'), 'utf-16-le'),
+                (flac_file.read(), str(_PLACEHOLDER_ID).encode('ascii'), 'ascii'))
+
+
+def _build_tree(root, files, cover_size):
+    templates = _templates(root, cover_size)
+    tree = os.path.join(root, 'music')
+    for i in range(files):
+        folder = os.path.join(tree, 'artist {}'.format(i // 500), 'album {}'.format(i // 10))
+        if i % 10 == 0:
+            os.makedirs(folder, exist_ok=True)
+        data, placeholder, encoding = templates[i % 2]
+        song_id = str(_PLACEHOLDER_ID + i + 1).encode(encoding)
+        extension = '.mp3' if i % 2 == 0 else '.flac'
+        with open(os.path.join(folder, 'track {}{}'.format(i % 10, extension)), 'wb') as song_file:
+            song_file.write(data.replace(placeholder, song_id, 1))
+    return tree
+
+
+def _timed(name, func, files):
+    begin = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - begin
+    print('{:32} {:8.2f} s {:10.0f} files/s   {}'.format(name, elapsed, files / elapsed, result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--cover-size', type=int, default=2048)
+    parser.add_argument('--keep', metavar='DIR', help='Build the tree in DIR and keep it')
+    args = parser.parse_args()
+
+    root = args.keep or tempfile.mkdtemp(prefix='ncm-library-')
+    try:
+        tree = os.path.join(root, 'music')
+        if not os.path.isdir(tree):
+            begin = time.perf_counter()
+            tree = _build_tree(root, args.files, args.cover_size)
+            print('Built {} files in {:.1f} s'.format(args.files, time.perf_counter() - begin))
+        files = [path for path, _, _ in _walk_audio_files(tree)]
+
+        def read_all(reader):
+            found = sum(1 for path, _, _ in _walk_audio_files(tree) if reader(path) is not None)
+            return '{} ids'.format(found)
+
+        _timed('walk + mutagen', lambda: read_all(_read_song_id_mutagen), len(files))
+        _timed('walk + header reader', lambda: read_all(read_song_id), len(files))
+
+        for workers in sorted({1, args.workers}):
+            index_path = os.path.join(root, 'library-{}.db'.format(workers))
+            # Start from an empty index, also when the tree is kept
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(index_path + suffix):
+                    os.remove(index_path + suffix)
+            index = LibraryIndex(index_path, workers)
+            _timed('index, {} thread(s)'.format(workers), lambda: index.scan(tree), len(files))
+            index.close()
+
+        index = LibraryIndex(os.path.join(root, 'library-{}.db'.format(args.workers)), args.workers)
+        _timed('rescan, unchanged', lambda: index.scan(tree), len(files))
+        for path in random.Random(1).sample(files, max(1, len(files) // 100)):
+            os.utime(path)
+        _timed('rescan, 1% touched', lambda: index.scan(tree), len(files))
+        begin = time.perf_counter()
+        for song_id in range(_PLACEHOLDER_ID + 1, _PLACEHOLDER_ID + 1001):
+            index.find(song_id)
+        print('{:32} {:8.1f} us'.format('find', (time.perf_counter() - begin) / 1000 * 1e6))
+        index.close()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
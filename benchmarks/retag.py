@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Time to tag a fresh MP3 and then retag it with a bigger cover and lyrics,
+with the previous two-pass tagging (MP3 parse, add_tags + save, ID3 parse,
+save) versus add_metadata_to_song.
+
+    python benchmarks/retag.py [size_mb] [rounds]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from mutagen.id3 import APIC, ID3, TIT2, USLT
+from mutagen.mp3 import MP3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncm.file_util import add_metadata_to_song  # noqa: E402
+
+# MPEG-1 layer 3, 128 kbps, 44.1 kHz frame
+_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+_SONG = {
+    'id': 1,
+    'name': 'bench',
+    'artists': [{'name': 'artist', 'id': 1}],
+    'album': {'id': 1, 'name': 'album', 'size': 1, 'publishTime': 0},
+    'no': 1,
+}
+
+
+def _old_tag(path, cover, lyrics):
+    audio = MP3(path, ID3=ID3)
+    if audio.tags is None:
+        audio.add_tags()
+        audio.save()
+    id3 = ID3(path)
+    id3.delall('APIC')
+    id3.delall('USLT')
+    id3.add(APIC(encoding=3, mime='image/jpeg', type=3, data=cover))
+    id3.add(TIT2(encoding=3, text='bench'))
+    id3['USLT::eng'] = USLT(encoding=3, lang='eng', desc='', text=lyrics)
+    id3.save(v2_version=3)
+
+
+def _new_tag(path, cover, lyrics):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        add_metadata_to_song(path, cover, _SONG, lyrics={'lyric': lyrics, 'tlyric': None})
+    finally:
+        sys.stdout = stdout
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    audio = _FRAME * (size_mb * 1024 * 1024 // len(_FRAME))
+    small_cover = os.urandom(30 * 1024)
+    large_cover = os.urandom(60 * 1024)
+    lyrics = '[00:01.00] la la la\n' * 200
+    print('{} MB mp3, {} rounds'.format(size_mb, rounds))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench.mp3')
+        for name, tag in (('two-pass', _old_tag), ('single-pass', _new_tag)):
+            first = 0.0
+            retag = 0.0
+            for _ in range(rounds):
+                with open(path, 'wb') as f:
+                    f.write(audio)
+                begin = time.perf_counter()
+                tag(path, small_cover, '')
+                first += time.perf_counter() - begin
+                begin = time.perf_counter()
+                tag(path, large_cover, lyrics)
+                retag += time.perf_counter() - begin
+            print('{:12} tag {:7.2f} ms, retag {:7.2f} ms'.format(name, first * 1000 / rounds, retag * 1000 / rounds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Compare single-stream and segmented download_file throughput against a
+local server that throttles every connection, like the NetEase cdn does.
+
+    python benchmarks/segmented_download.py [size_mb] [rate_mb_per_connection]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from _server import random_payload, start_server  # noqa: E402
+from ncm import config  # noqa: E402
+from ncm.downloader import download_file  # noqa: E402
+
+
+def _timed_download(url, folder, name, segments):
+    begin = time.perf_counter()
+    download_file(url, name, folder, segments=segments)
+    return time.perf_counter() - begin
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    rate_mb = float(sys.argv[2]) if len(sys.argv) > 2 else 4
+    payload = random_payload(size_mb * 1024 * 1024)
+    server, base_url = start_server(payload, rate=int(rate_mb * 1024 * 1024))
+    # Quiet output, and let every segment have its own connection
+    config.DOWNLOAD_JOBS = 2
+    config.DOWNLOAD_HOST_LIMIT = 16
+
+    with tempfile.TemporaryDirectory() as folder:
+        print('{} MB file, {} MB/s per connection'.format(size_mb, rate_mb))
+        for segments in (1, 2, 4, 8):
+            name = 'segments_{}.flac'.format(segments)
+            elapsed = _timed_download(base_url + '/' + name, folder, name, segments)
+            with open(os.path.join(folder, name), 'rb') as file:
+                assert file.read() == payload
+            print('segments={}: {:6.2f}s, {:7.2f} MB/s'.format(segments, elapsed, size_mb / elapsed))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
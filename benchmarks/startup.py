@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Wall time of importing ncm.start as a library and of `ncm --help`, each in a
+fresh interpreter. Pass other checkouts of the repo to compare, e.g. one made
+with `git worktree add /tmp/ncm-old <commit>`.
+
+    python benchmarks/startup.py [repo_path ...] [--rounds N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+_COMMANDS = (
+    ('import ncm.start', 'import ncm.start'),
+    ('ncm --help', 'import sys; sys.argv = ["ncm", "--help"]; from ncm.start import main; main()'),
+)
+
+
+def _measure(repo_path, code, rounds, home):
+    env = dict(os.environ, PYTHONPATH=repo_path, HOME=home)
+    # Run from home, python -c puts the working directory first on sys.path
+    command = [sys.executable, '-c', code]
+    # Warm up the bytecode cache and the file system cache
+    subprocess.run(command, env=env, cwd=home, stdout=subprocess.DEVNULL, check=True)
+    samples = []
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        subprocess.run(command, env=env, cwd=home, stdout=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - begin)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('repos', nargs='*',
+                        default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')])
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    baseline = _measure('', 'pass', args.rounds, tempfile.gettempdir())
+    print('bare interpreter: {:7.1f} ms'.format(baseline * 1000))
+    for repo in args.repos:
+        # Empty home, so the config file written on first load doesn't touch the real one
+        with tempfile.TemporaryDirectory() as home:
+            for name, code in _COMMANDS:
+                elapsed = _measure(os.path.abspath(repo), code, args.rounds, home)
+                print('{:40} {:16} {:7.1f} ms'.format(repo, name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+CPU cost per downloaded MB of the old 1 KB iter_content loop versus
+iter_response_chunks, both with a progress bar, against a local server.
+
+    python benchmarks/stream_copy.py [size_mb] [rounds]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from _server import random_payload, start_server  # noqa: E402
+from ncm.downloader import iter_response_chunks  # noqa: E402
+from ncm.session import create_session  # noqa: E402
+
+
+class _SizeBasedProgress(object):
+    """
+    The previous ProgressBar logic: print whenever 10 KB more arrived
+    """
+
+    def __init__(self, total):
+        super().__init__()
+        self.count = 0
+        self.prev_count = 0
+        self.total = total
+        self.out = open(os.devnull, 'w')
+
+    def refresh(self, count):
+        self.count += count
+        if (self.count - self.prev_count) > 10240:
+            self.prev_count = self.count
+            print(self.count / self.total, end='\r', file=self.out)
+
+
+def _old_copy(response, file, total):
+    progress = _SizeBasedProgress(total)
+    for buffer in response.iter_content(chunk_size=1024):
+        if buffer:
+            file.write(buffer)
+            progress.refresh(len(buffer))
+
+
+def _new_copy(response, file, total):
+    from ncm import downloader
+    progress = downloader.ProgressBar('bench', total)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for buffer in iter_response_chunks(response):
+            file.write(buffer)
+            progress.refresh(len(buffer))
+    finally:
+        sys.stdout = stdout
+
+
+def _measure(copy, session, url, path, size_mb, rounds):
+    cpu = 0.0
+    wall = 0.0
+    for _ in range(rounds):
+        cpu_begin = time.process_time()
+        wall_begin = time.perf_counter()
+        with session.get(url, stream=True) as response, open(path, 'wb') as file:
+            copy(response, file, int(response.headers['Content-Length']))
+        cpu += time.process_time() - cpu_begin
+        wall += time.perf_counter() - wall_begin
+    return cpu * 1000 / (size_mb * rounds), size_mb * rounds / wall
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    server, base_url = start_server(random_payload(size_mb * 1024 * 1024))
+    session = create_session(pool_size=2, retries=0, keep_alive=True)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench.flac')
+        print('{} MB x {} rounds (client cpu includes the in-process server)'.format(size_mb, rounds))
+        for name, copy in (('iter_content(1 KB)', _old_copy), ('iter_response_chunks', _new_copy)):
+            cpu_ms, throughput = _measure(copy, session, base_url + '/bench', path, size_mb, rounds)
+            print('{:22} {:7.2f} ms cpu/MB, {:8.2f} MB/s'.format(name, cpu_ms, throughput))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+# The api and cache are imported by the functions using them, file_util only
+# needs song_disc and is imported by the cpu worker processes
+
+
+def parse_disc(disc_raw):
+    """
+    :param disc_raw: the 'disc' or 'cd' field of a song, e.g. '1', '2/3' or 2
+    :return: (disc number, disc total), None when unknown
+    """
+    if isinstance(disc_raw, str):
+        parts = disc_raw.split('/')
+        disc_number = int(parts[0]) if parts[0].isdigit() else None
+        disc_total = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+        return disc_number, disc_total
+    if isinstance(disc_raw, int):
+        return disc_raw, None
+    return None, None
+
+
+def song_disc(song):
+    """
+    :return: (disc number, disc total) of a song, None when unknown
+    """
+    return parse_disc(song.get('disc') or song.get('cd'))
+
+
+class AlbumIndex(object):
+    """
+    Disc and track numbers of the songs of an album, worked out once from its
+    song list. Tracks are numbered in album order within their disc.
+    """
+
+    def __init__(self, album_id, tracks, disc_track_count, disc_total):
+        """
+        :param tracks: dict of song id => (disc number, track number in the disc)
+        :param disc_track_count: dict of disc number => number of tracks
+        """
+        super().__init__()
+        self.album_id = album_id
+        self.tracks = tracks
+        self.disc_track_count = disc_track_count
+        self.disc_total = disc_total
+
+    @classmethod
+    def from_songs(cls, album_id, songs):
+        tracks = {}
+        disc_track_count = {}
+        disc_total = None
+        for song in songs:
+            disc_number, disc_total_from_song = song_disc(song)
+            track_number = None
+            if disc_number:
+                disc_track_count[disc_number] = disc_track_count.get(disc_number, 0) + 1
+                track_number = disc_track_count[disc_number]
+            tracks[song['id']] = (disc_number, track_number)
+            if disc_total is None and disc_total_from_song:
+                disc_total = disc_total_from_song
+        if disc_total is None and disc_track_count:
+            disc_total = max(disc_track_count)
+        return cls(album_id, tracks, disc_track_count, disc_total)
+
+    @classmethod
+    def from_dict(cls, data):
+        # JSON object keys are strings
+        tracks = {int(song_id): tuple(track) for song_id, track in data['tracks'].items()}
+        disc_track_count = {int(disc): count for disc, count in data['disc_track_count'].items()}
+        return cls(data['album_id'], tracks, disc_track_count, data['disc_total'])
+
+    def to_dict(self):
+        return {
+            'album_id': self.album_id,
+            'tracks': {str(song_id): list(track) for song_id, track in self.tracks.items()},
+            'disc_track_count': {str(disc): count for disc, count in self.disc_track_count.items()},
+            'disc_total': self.disc_total
+        }
+
+    def metadata_hint(self, song):
+        """
+        :param song: a song of the album
+        :return: dict with disc_number, disc_total, track_number and track_total
+        """
+        disc_number, _ = song_disc(song)
+        indexed_disc, track_number = self.tracks.get(song['id'], (None, None))
+        if disc_number is None:
+            disc_number = indexed_disc
+        return {
+            'disc_number': disc_number,
+            'disc_total': self.disc_total,
+            'track_number': track_number or song.get('no'),
+            'track_total': self.disc_track_count.get(disc_number) if disc_number else None
+        }
+
+
+class AlbumIndexCache(object):
+    """
+    Album indexes shared by the tracks of a run, each album is indexed once and
+    kept in the metadata cache, so later runs need neither its songs nor the work
+    """
+
+    def __init__(self, api=None, cache=None):
+        super().__init__()
+        self.api = api
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._album_locks = {}
+        self._indexes = {}
+
+    def get(self, album_id):
+        """
+        :return: AlbumIndex, the album songs are only fetched when it is not cached
+        """
+        album_id = int(album_id)
+        with self._lock:
+            album_lock = self._album_locks.setdefault(album_id, threading.Lock())
+        with album_lock:
+            if album_id not in self._indexes:
+                data = self.cache.get('album_index', album_id) if self.cache is not None else None
+                if data is not None:
+                    self._indexes[album_id] = AlbumIndex.from_dict(data)
+                else:
+                    from ncm.api import get_api
+                    api = self.api if self.api is not None else get_api()
+                    self._store(AlbumIndex.from_songs(album_id, api.get_album_songs(album_id)))
+            return self._indexes[album_id]
+
+    def put(self, album_id, songs):
+        """
+        Index the songs of an album already at hand
+        :return: AlbumIndex
+        """
+        index = AlbumIndex.from_songs(int(album_id), songs)
+        with self._lock:
+            self._store(index)
+        return index
+
+    def _store(self, index):
+        self._indexes[index.album_id] = index
+        if self.cache is not None:
+            self.cache.set('album_index', index.album_id, index.to_dict())
+
+
+_album_indexes = None
+_album_indexes_lock = threading.Lock()
+
+
+def get_album_indexes():
+    """
+    Get the process-wide album index cache, backed by the metadata cache when enabled
+    """
+    from ncm.cache import get_cache
+
+    global _album_indexes
+    with _album_indexes_lock:
+        if _album_indexes is None:
+            _album_indexes = AlbumIndexCache(cache=get_cache())
+        return _album_indexes
@@ -1,49 +1,191 @@
 # -*- coding: utf-8 -*-
 
-import requests
+import itertools
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from ncm import config
+from ncm.cache import get_cache
 from ncm.encrypt import encrypted_request
 from ncm.constants import get_headers, get_program_url, program_download_url
 from ncm.constants import lyric_url, song_download_url
 from ncm.constants import get_song_url
+from ncm.constants import get_songs_url
 from ncm.constants import get_album_url
 from ncm.constants import get_artist_url
 from ncm.constants import get_playlist_url
 from ncm.constants import get_radio_url
+from ncm.pool import get_host_limiter
+from ncm.ratelimit import ENDPOINT_DETAIL, ENDPOINT_LYRIC, ENDPOINT_URL
+from ncm.ratelimit import THROTTLE_STATUS_CODES
+from ncm.ratelimit import get_rate_limiter
+from ncm.exceptions import ApiError, CircuitOpenError, RetryExhaustedError
+from ncm.retry import RetryPolicy, get_circuit_breaker
+from ncm.session import get_session
+
+# Max ids per batched request
+SONG_DETAIL_BATCH_SIZE = 500
+SONG_URL_BATCH_SIZE = 100
+RADIO_PAGE_SIZE = 100
+
+# Api code 406 and throttling http status codes, all mean "busy, retry later"
+BUSY_CODES = (406,) + THROTTLE_STATUS_CODES
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def radio_page_offsets(result, page_size=RADIO_PAGE_SIZE, latest=None):
+    """
+    Offsets of the radio pages after the first one, from the program count of
+    the first page. Unbounded when the count is missing, 'more' ends the paging.
+    """
+    if 'count' not in result:
+        return itertools.count(page_size, page_size)
+    total = result['count'] if latest is None else min(result['count'], latest)
+    return iter(range(page_size, total, page_size))
+
+
+class ProgramFilter(object):
+    """
+    Take the programs of radio pages, newest first, until one is older than
+    since or latest programs have been taken. Programs moved to the next page
+    by a new episode while paging are only taken once.
+    """
+
+    def __init__(self, since=None, latest=None):
+        """
+        :param since: seconds since epoch, older programs end the paging
+        :param latest: max number of programs
+        """
+        super().__init__()
+        self.since = since
+        self.latest = latest
+        self.done = False
+        self._seen = set()
+
+    def take(self, programs):
+        """
+        :return: list of the programs to download
+        """
+        taken = []
+        for program in programs or ():
+            if self.done:
+                break
+            if self.since is not None and program.get('createTime', 0) / 1000 < self.since:
+                self.done = True
+                break
+            if program['id'] in self._seen:
+                continue
+            self._seen.add(program['id'])
+            taken.append(program)
+            if self.latest is not None and len(self._seen) >= self.latest:
+                self.done = True
+        return taken
 
 
 class CloudApi(object):
 
-    def __init__(self, timeout=30, user_cookie=None):
+    def __init__(self, timeout=30, user_cookie=None, session=None, cache=None, rate_limiter=None,
+                 retry_policy=None, wait_open_circuit=True):
+        """
+        :param wait_open_circuit: wait for a paused endpoint class instead of raising CircuitOpenError,
+            until its trial requests failed BREAKER_MAX_WAIT_OPENINGS times in a row
+        """
         super().__init__()
-        self.session = requests.session()
-        self.session.headers.update(get_headers(user_cookie))
+        self.wait_open_circuit = wait_open_circuit
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.session = session if session is not None else get_session()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
+        # Api only headers, the session is shared with cdn downloads
+        self.headers = get_headers(user_cookie)
         self.timeout = timeout
+        self.cache = cache
 
-    def get_request(self, url):
+    def _cached(self, kind, key, fetch):
+        """
+        Return the cached value of kind/key, or call fetch and cache its result
+        """
+        if self.cache is None:
+            return fetch()
+        value = self.cache.get(kind, key)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.cache.set(kind, key, value)
+        return value
 
-        response = self.session.get(url, timeout=self.timeout)
-        result = response.json()
-        while result['code'] == 406:
-            print("Busy! retry after 20 seconds")
-            time.sleep(20)
-            response = self.session.get(url, timeout=self.timeout)
-            result = response.json()
-        if result['code'] != 200:
-            print('Return {} when try to get {}'.format(result, url))
+    def _send(self, method, url, endpoint, data=None):
+        self.rate_limiter.acquire(endpoint)
+        with get_host_limiter().acquire(url):
+            response = self.session.request(method, url, data=data, headers=self.headers, timeout=self.timeout)
+        if response.status_code in THROTTLE_STATUS_CODES:
+            result = {'code': response.status_code}
         else:
-            return result
+            result = response.json()
+        self.rate_limiter.report(endpoint, result['code'] in BUSY_CODES)
+        return result
 
-    def post_request(self, url, params):
+    def _request(self, method, url, endpoint, params=None):
+        """
+        Send a request, retrying busy answers, timeouts and connection errors
+        :raise CircuitOpenError: the endpoint class kept failing recently, and wait_open_circuit is off
+            or its trials kept failing too
+        :raise RetryExhaustedError: the retry policy gave up
+        """
+        breaker = get_circuit_breaker(endpoint)
+        attempt = 0
+        while True:
+            try:
+                breaker.before_request()
+            except CircuitOpenError as e:
+                if not self.wait_open_circuit or not breaker.worth_waiting():
+                    raise
+                time.sleep(e.retry_after)
+                continue
+            attempt += 1
+            succeeded = False
+            try:
+                data = encrypted_request(params) if params is not None else None
+                result = self._send(method, url, endpoint, data)
+                succeeded = result['code'] not in BUSY_CODES
+            except (IOError, ValueError) as e:
+                cause = e
+            else:
+                if succeeded:
+                    return result
+                cause = 'busy code {}'.format(result['code'])
+            finally:
+                # Also on unexpected errors, a half open breaker waits for the outcome
+                if succeeded:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            if not self.retry_policy.should_retry(attempt):
+                raise RetryExhaustedError(url, attempt, cause)
+            time.sleep(self.retry_policy.backoff(attempt))
 
-        data = encrypted_request(params)
-        response = self.session.post(url, data=data, timeout=self.timeout)
-        result = response.json()
+    def get_request(self, url, endpoint=ENDPOINT_DETAIL):
+        """
+        :raise ApiError: the api answered with a code other than 200
+        """
+        result = self._request('GET', url, endpoint)
         if result['code'] != 200:
-            print('Return {} when try to post {} => {}'.format(result, params, url))
-        else:
-            return result
+            raise ApiError(result['code'], url, 'Return {} when try to get {}'.format(result, url))
+        return result
+
+    def post_request(self, url, params, endpoint=ENDPOINT_DETAIL):
+        """
+        :raise ApiError: the api answered with a code other than 200
+        """
+        result = self._request('POST', url, endpoint, params)
+        if result['code'] != 200:
+            raise ApiError(result['code'], url, 'Return {} when try to post {} => {}'.format(result, params, url))
+        return result
 
     def get_song(self, song_id):
         """
@@ -51,9 +193,37 @@ class CloudApi(object):
         :param song_id:
         :return:
         """
-        url = get_song_url(song_id)
-        result = self.get_request(url)
-        return result['songs'][0]
+        def fetch():
+            result = self.get_request(get_song_url(song_id))
+            return result['songs'][0]
+        return self._cached('song', song_id, fetch)
+
+    def get_songs(self, song_ids):
+        """
+        Get songs info by song ids, split into chunks of SONG_DETAIL_BATCH_SIZE
+        :param song_ids: list of song id
+        :return: list of song info in the order of song_ids, unknown ids are left out
+        """
+        return [song for page in self.iter_songs(song_ids) for song in page]
+
+    def iter_songs(self, song_ids, page_size=SONG_DETAIL_BATCH_SIZE):
+        """
+        Get songs info by song ids one page at a time, a page is only requested
+        when the previous one has been consumed
+        :param song_ids: list of song id
+        :param page_size: ids per page, at most SONG_DETAIL_BATCH_SIZE
+        :return: generator of lists of song info in the order of song_ids, unknown ids are left out
+        """
+        for page_ids in chunks(song_ids, min(max(1, page_size), SONG_DETAIL_BATCH_SIZE)):
+            songs = self.cache.get_many('song', page_ids) if self.cache is not None else {}
+            missing = [song_id for song_id in page_ids if song_id not in songs]
+            if missing:
+                result = self.get_request(get_songs_url(missing))
+                fetched = {song['id']: song for song in result['songs']}
+                songs.update(fetched)
+                if self.cache is not None:
+                    self.cache.set_many('song', fetched)
+            yield [songs[song_id] for song_id in page_ids if song_id in songs]
 
     def get_program(self, program_id):
         """
@@ -62,10 +232,12 @@ class CloudApi(object):
         :param program_id:
         :return:
         """
-        url = get_program_url(program_id)
-        csrf = ''
-        result = self.post_request(url, {'id': program_id, 'csrf_token': csrf})
-        return result['program']
+        def fetch():
+            url = get_program_url(program_id)
+            csrf = ''
+            result = self.post_request(url, {'id': program_id, 'csrf_token': csrf})
+            return result['program']
+        return self._cached('program', program_id, fetch)
 
     def get_program_url(self, program, encode_type="aac", level="standard"):
         """
@@ -84,10 +256,10 @@ class CloudApi(object):
         :param album_id:
         :return:
         """
-        url = get_album_url(album_id)
-        result = self.get_request(url)
-
-        return result['album']['songs']
+        def fetch():
+            result = self.get_request(get_album_url(album_id))
+            return result['album']['songs']
+        return self._cached('album', album_id, fetch)
 
     def get_song_url(self, song_id, bit_rate=320000):
         """Get a song's download url.
@@ -103,12 +275,27 @@ class CloudApi(object):
         url = song_download_url
         csrf = ''
         params = {'ids': [song_id], 'br': bit_rate, 'csrf_token': csrf}
-        result = self.post_request(url, params)
-        if result and result.get('data') and len(result['data']) > 0:
+        result = self.post_request(url, params, ENDPOINT_URL)
+        if result.get('data'):
             song_url = result['data'][0]['url']
             return song_url
         return None
 
+    def get_song_urls(self, song_ids, bit_rate=320000):
+        """Get download urls of many songs, split into chunks of SONG_URL_BATCH_SIZE.
+        :params song_ids: list of song id<int>.
+        :params bit_rate: same as get_song_url
+        :return: dict of song id => url, url is None when not available
+        """
+        urls = {}
+        for chunk in chunks(list(song_ids), SONG_URL_BATCH_SIZE):
+            params = {'ids': chunk, 'br': bit_rate, 'csrf_token': ''}
+            result = self.post_request(song_download_url, params, ENDPOINT_URL)
+            if result.get('data'):
+                for item in result['data']:
+                    urls[item['id']] = item.get('url')
+        return urls
+
     def get_song_lyrics(self, song_id):
         """Get raw and translated lyrics for a song.
         :param song_id:
@@ -121,9 +308,7 @@ class CloudApi(object):
             'tv': -1,  # translated lyric
             'csrf_token': ''
         }
-        result = self.post_request(lyric_url, params)
-        if not result:
-            return None
+        result = self.post_request(lyric_url, params, ENDPOINT_LYRIC)
         return {
             'lyric': result.get('lrc', {}).get('lyric'),
             'tlyric': result.get('tlyric', {}).get('lyric')
@@ -135,19 +320,23 @@ class CloudApi(object):
         :param artist_id:
         :return:
         """
-        url = get_artist_url(artist_id)
-        result = self.get_request(url)
-        return result['hotSongs']
+        def fetch():
+            result = self.get_request(get_artist_url(artist_id))
+            return result['hotSongs']
+        return self._cached('artist', artist_id, fetch)
 
     def get_playlist_songs(self, playlist_id):
         """
-        Get a public playlist all songs
+        Get the track ids and name of a public playlist, song details are left
+        to get_songs / iter_songs
         :param playlist_id:
-        :return:
+        :return: (list of {'id': song id, ...}, playlist name)
         """
-        url = get_playlist_url(playlist_id)
-        result = self.get_request(url)
-        return result['playlist']['trackIds'], result['playlist']['name']
+        def fetch():
+            result = self.get_request(get_playlist_url(playlist_id))
+            return [result['playlist']['trackIds'], result['playlist']['name']]
+        track_ids, name = self._cached('playlist', playlist_id, fetch)
+        return track_ids, name
 
     def get_radio_programs(self, radio_id):
         """
@@ -155,16 +344,56 @@ class CloudApi(object):
         :param radio_id:
         :return: A list of program objects from the radio.
         """
-        programs = []
-        limit = 100
-        offset = 0
-        while True:
-            url = get_radio_url(radio_id, limit=limit, offset=offset)
-            result = self.get_request(url)
-            if result is None or 'programs' not in result:
-                break
-            programs.extend(result['programs'])
-            if not result.get('more', False):
-                break
-            offset += limit
-        return programs
+        return list(self.iter_radio_programs(radio_id))
+
+    def iter_radio_programs(self, radio_id, since=None, latest=None, workers=None):
+        """
+        Get the programs of a DJ radio newest first as their pages arrive. The
+        first page tells the program count, the following pages are requested
+        concurrently, at most workers at a time and within the rate limit.
+        :param radio_id:
+        :param since: only programs published at or after this time, seconds since epoch
+        :param latest: only the newest N programs
+        :param workers: pages requested at a time, config.RADIO_PAGE_WORKERS by default
+        :return: generator of program objects
+        """
+        def fetch(offset):
+            return self.get_request(get_radio_url(radio_id, limit=RADIO_PAGE_SIZE, offset=offset))
+
+        program_filter = ProgramFilter(since, latest)
+        result = fetch(0)
+        yield from program_filter.take(result.get('programs'))
+        if program_filter.done or not result.get('more', False):
+            return
+        offsets = radio_page_offsets(result, latest=latest)
+        workers = max(1, config.RADIO_PAGE_WORKERS if workers is None else workers)
+        with ThreadPoolExecutor(workers) as executor:
+            futures = deque(executor.submit(fetch, offset) for offset in itertools.islice(offsets, workers))
+            try:
+                while futures:
+                    result = futures.popleft().result()
+                    yield from program_filter.take(result.get('programs'))
+                    if program_filter.done or not result.get('more', False):
+                        break
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        futures.append(executor.submit(fetch, offset))
+            finally:
+                # Pages past the end or older than since are not needed
+                for future in futures:
+                    future.cancel()
+
+
+_api = None
+_api_lock = threading.Lock()
+
+
+def get_api():
+    """
+    Get the process-wide CloudApi, created with the configured user cookie
+    """
+    global _api
+    with _api_lock:
+        if _api is None:
+            _api = CloudApi(user_cookie=config.USER_COOKIE, cache=get_cache())
+        return _api
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import itertools
+import json
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from ncm import config
+from ncm.api import BUSY_CODES, RADIO_PAGE_SIZE, SONG_DETAIL_BATCH_SIZE, SONG_URL_BATCH_SIZE, chunks
+from ncm.api import ProgramFilter, radio_page_offsets
+from ncm.encrypt import encrypted_request
+from ncm.constants import get_headers
+from ncm.constants import lyric_url, song_download_url
+from ncm.constants import get_song_url
+from ncm.constants import get_songs_url
+from ncm.constants import get_album_url
+from ncm.constants import get_playlist_url
+from ncm.constants import get_radio_url
+from ncm.ratelimit import ENDPOINT_DETAIL, ENDPOINT_LYRIC, ENDPOINT_URL
+from ncm.ratelimit import THROTTLE_STATUS_CODES
+from ncm.ratelimit import get_rate_limiter
+from ncm.exceptions import ApiError, CircuitOpenError, RetryExhaustedError
+from ncm.retry import RetryPolicy, get_circuit_breaker
+
+
+class AsyncCloudApi(object):
+    """
+    asyncio counterpart of CloudApi, built on aiohttp. Many lookups can be awaited
+    together from one thread. Requests share CloudApi's rate limiter, and its delays
+    are awaited without blocking the loop.
+
+        async with AsyncCloudApi(user_cookie=config.USER_COOKIE) as api:
+            songs = await asyncio.gather(*[api.get_song(song_id) for song_id in song_ids])
+    """
+
+    def __init__(self, timeout=30, user_cookie=None, cache=None, limit_per_host=None, rate_limiter=None,
+                 retry_policy=None, wait_open_circuit=True):
+        """
+        :param wait_open_circuit: wait for a paused endpoint class instead of raising CircuitOpenError,
+            until its trial requests failed BREAKER_MAX_WAIT_OPENINGS times in a row
+        """
+        super().__init__()
+        if aiohttp is None:
+            raise ImportError('AsyncCloudApi requires aiohttp, install it with: pip install netease-cloud-music-dl[async]')
+        self.headers = get_headers(user_cookie)
+        self.timeout = timeout
+        self.cache = cache
+        self.limit_per_host = limit_per_host or config.HTTP_POOL_SIZE
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.wait_open_circuit = wait_open_circuit
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers, trust_env=True,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _send(self, method, url, endpoint, data=None):
+        delay = self.rate_limiter.reserve(endpoint)
+        if delay:
+            await asyncio.sleep(delay)
+        async with self._get_session().request(method, url, data=data) as response:
+            if response.status in THROTTLE_STATUS_CODES:
+                result = {'code': response.status}
+            else:
+                result = json.loads(await response.text())
+        self.rate_limiter.report(endpoint, result['code'] in BUSY_CODES)
+        return result
+
+    async def _request(self, method, url, endpoint, params=None):
+        """
+        Send a request, retrying busy answers, timeouts and connection errors
+        :raise CircuitOpenError: the endpoint class kept failing recently, and wait_open_circuit is off
+            or its trials kept failing too
+        :raise RetryExhaustedError: the retry policy gave up
+        """
+        breaker = get_circuit_breaker(endpoint)
+        attempt = 0
+        while True:
+            try:
+                breaker.before_request()
+            except CircuitOpenError as e:
+                if not self.wait_open_circuit or not breaker.worth_waiting():
+                    raise
+                await asyncio.sleep(e.retry_after)
+                continue
+            attempt += 1
+            succeeded = False
+            try:
+                data = encrypted_request(params) if params is not None else None
+                result = await self._send(method, url, endpoint, data)
+                succeeded = result['code'] not in BUSY_CODES
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                cause = e
+            else:
+                if succeeded:
+                    return result
+                cause = 'busy code {}'.format(result['code'])
+            finally:
+                # Also on unexpected errors and cancellation, a half open breaker waits for the outcome
+                if succeeded:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            if not self.retry_policy.should_retry(attempt):
+                raise RetryExhaustedError(url, attempt, cause)
+            await asyncio.sleep(self.retry_policy.backoff(attempt))
+
+    async def _cached(self, kind, key, fetch):
+        if self.cache is None:
+            return await fetch()
+        value = self.cache.get(kind, key)
+        if value is None:
+            value = await fetch()
+            if value is not None:
+                self.cache.set(kind, key, value)
+        return value
+
+    async def get_request(self, url, endpoint=ENDPOINT_DETAIL):
+        """
+        :raise ApiError: the api answered with a code other than 200
+        """
+        result = await self._request('GET', url, endpoint)
+        if result['code'] != 200:
+            raise ApiError(result['code'], url, 'Return {} when try to get {}'.format(result, url))
+        return result
+
+    async def post_request(self, url, params, endpoint=ENDPOINT_DETAIL):
+        """
+        :raise ApiError: the api answered with a code other than 200
+        """
+        result = await self._request('POST', url, endpoint, params)
+        if result['code'] != 200:
+            raise ApiError(result['code'], url, 'Return {} when try to post {} => {}'.format(result, params, url))
+        return result
+
+    async def get_song(self, song_id):
+        """
+        Get song info by song id
+        :param song_id:
+        :return:
+        """
+        async def fetch():
+            result = await self.get_request(get_song_url(song_id))
+            return result['songs'][0]
+        return await self._cached('song', song_id, fetch)
+
+    async def get_songs(self, song_ids):
+        """
+        Get songs info by song ids, chunks are requested concurrently
+        :param song_ids: list of song id
+        :return: list of song info in the order of song_ids, unknown ids are left out
+        """
+        songs = self.cache.get_many('song', song_ids) if self.cache is not None else {}
+        missing = [song_id for song_id in song_ids if song_id not in songs]
+        results = await asyncio.gather(*[self.get_request(get_songs_url(chunk))
+                                         for chunk in chunks(missing, SONG_DETAIL_BATCH_SIZE)])
+        for result in results:
+            fetched = {song['id']: song for song in result['songs']}
+            songs.update(fetched)
+            if self.cache is not None:
+                self.cache.set_many('song', fetched)
+        return [songs[song_id] for song_id in song_ids if song_id in songs]
+
+    async def get_album_songs(self, album_id):
+        """
+        Get all album songs info by album id
+        :param album_id:
+        :return:
+        """
+        async def fetch():
+            result = await self.get_request(get_album_url(album_id))
+            return result['album']['songs']
+        return await self._cached('album', album_id, fetch)
+
+    async def get_playlist_songs(self, playlist_id):
+        """
+        Get the track ids and name of a public playlist, song details are left
+        to get_songs
+        :param playlist_id:
+        :return: (list of {'id': song id, ...}, playlist name)
+        """
+        async def fetch():
+            result = await self.get_request(get_playlist_url(playlist_id))
+            return [result['playlist']['trackIds'], result['playlist']['name']]
+        track_ids, name = await self._cached('playlist', playlist_id, fetch)
+        return track_ids, name
+
+    async def get_radio_programs(self, radio_id, since=None, latest=None, workers=None):
+        """
+        Get the programs of a DJ radio newest first. The first page tells the
+        program count, the following pages are requested workers at a time.
+        :param radio_id:
+        :param since: only programs published at or after this time, seconds since epoch
+        :param latest: only the newest N programs
+        :param workers: pages requested at a time, config.RADIO_PAGE_WORKERS by default
+        :return: A list of program objects from the radio.
+        """
+        async def fetch(offset):
+            return await self.get_request(get_radio_url(radio_id, limit=RADIO_PAGE_SIZE, offset=offset))
+
+        program_filter = ProgramFilter(since, latest)
+        result = await fetch(0)
+        programs = program_filter.take(result.get('programs'))
+        if program_filter.done or not result.get('more', False):
+            return programs
+        offsets = radio_page_offsets(result, latest=latest)
+        workers = max(1, config.RADIO_PAGE_WORKERS if workers is None else workers)
+        while True:
+            batch = list(itertools.islice(offsets, workers))
+            if not batch:
+                return programs
+            for result in await asyncio.gather(*[fetch(offset) for offset in batch]):
+                programs.extend(program_filter.take(result.get('programs')))
+                if program_filter.done or not result.get('more', False):
+                    return programs
+
+    async def get_song_lyrics(self, song_id):
+        """Get raw and translated lyrics for a song.
+        :param song_id:
+        :return: dict with keys 'lyric' and 'tlyric', values may be None
+        """
+        params = {
+            'id': song_id,
+            'lv': -1,  # full lyric
+            'kv': -1,  # karaoke
+            'tv': -1,  # translated lyric
+            'csrf_token': ''
+        }
+        result = await self.post_request(lyric_url, params, ENDPOINT_LYRIC)
+        return {
+            'lyric': result.get('lrc', {}).get('lyric'),
+            'tlyric': result.get('tlyric', {}).get('lyric')
+        }
+
+    async def get_song_url(self, song_id, bit_rate=320000):
+        """Get a song's download url.
+        :params song_id: song id<int>.
+        :params bit_rate: same as CloudApi.get_song_url
+        :return:
+        """
+        urls = await self.get_song_urls([song_id], bit_rate)
+        return urls.get(song_id)
+
+    async def get_song_urls(self, song_ids, bit_rate=320000):
+        """Get download urls of many songs, chunks are requested concurrently.
+        :params song_ids: list of song id<int>.
+        :params bit_rate: same as CloudApi.get_song_url
+        :return: dict of song id => url, url is None when not available
+        """
+        results = await asyncio.gather(*[
+            self.post_request(song_download_url, {'ids': chunk, 'br': bit_rate, 'csrf_token': ''}, ENDPOINT_URL)
+            for chunk in chunks(list(song_ids), SONG_URL_BATCH_SIZE)])
+        urls = {}
+        for result in results:
+            if result.get('data'):
+                for item in result['data']:
+                    urls[item['id']] = item.get('url')
+        return urls
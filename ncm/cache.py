@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+from ncm import config
+
+# Entity type => seconds before a cached entry is refetched
+CACHE_TTL = {
+    'song': 30 * 24 * 3600,
+    'album': 7 * 24 * 3600,
+    'album_index': 7 * 24 * 3600,
+    'artist': 24 * 3600,
+    'program': 30 * 24 * 3600,
+    'playlist': 10 * 60,
+}
+
+# Check the total size after this many writes
+_EVICT_CHECK_INTERVAL = 100
+
+
+class MetadataCache(object):
+    """
+    Api responses kept in SQLite, keyed by entity type and id. Entries expire
+    after their type's ttl, and the least recently used ones are evicted once the
+    cache grows past max_size bytes.
+    """
+
+    def __init__(self, path, max_size, ttl=None):
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+        self.ttl = dict(CACHE_TTL, **(ttl or {}))
+        self._lock = threading.Lock()
+        self._writes = 0
+        import sqlite3
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                           'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                           'created REAL NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (kind, key))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def get(self, kind, key):
+        """
+        :return: the cached value, None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM entries WHERE kind = ? AND key = ?',
+                                     (kind, str(key))).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl.get(kind, 0):
+                self._conn.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, str(key)))
+                return None
+            self._conn.execute('UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?', (now, kind, str(key)))
+        return json.loads(row[0])
+
+    def get_many(self, kind, keys):
+        """
+        :return: dict of key => value for the keys found in the cache
+        """
+        values = {}
+        for key in keys:
+            value = self.get(kind, key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, kind, key, value):
+        self.set_many(kind, {key: value})
+
+    def set_many(self, kind, values):
+        now = time.time()
+        rows = []
+        for key, value in values.items():
+            data = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+            rows.append((kind, str(key), data, len(data), now, now))
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._conn.execute('COMMIT')
+            self._writes += len(rows)
+            if self._writes >= _EVICT_CHECK_INTERVAL:
+                self._writes = 0
+                self._evict()
+
+    def _evict(self):
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_size:
+            return
+        # Evict down to 90% of the limit so the next writes don't evict again
+        excess = total - int(self.max_size * 0.9)
+        self._conn.execute('BEGIN')
+        for kind, key, size in self._conn.execute(
+                'SELECT kind, key, size FROM entries ORDER BY accessed').fetchall():
+            if excess <= 0:
+                break
+            self._conn.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, key))
+            excess -= size
+        self._conn.execute('COMMIT')
+
+    def invalidate(self, kind=None, key=None):
+        """
+        Remove entries of a type, of one id, or everything
+        :return: number of removed entries
+        """
+        with self._lock:
+            if kind is None:
+                cursor = self._conn.execute('DELETE FROM entries')
+            elif key is None:
+                cursor = self._conn.execute('DELETE FROM entries WHERE kind = ?', (kind,))
+            else:
+                cursor = self._conn.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, str(key)))
+            return cursor.rowcount
+
+    def stats(self):
+        """
+        :return: list of (kind, entry count, total bytes, expired count)
+        """
+        now = time.time()
+        result = []
+        with self._lock:
+            rows = self._conn.execute('SELECT kind, COUNT(*), SUM(size) FROM entries GROUP BY kind').fetchall()
+            for kind, count, size in rows:
+                expired = self._conn.execute('SELECT COUNT(*) FROM entries WHERE kind = ? AND created < ?',
+                                             (kind, now - self.ttl.get(kind, 0))).fetchone()[0]
+                result.append((kind, count, size, expired))
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Get the process-wide metadata cache, None when disabled in config
+    """
+    global _cache
+    if not config.CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            os.makedirs(os.path.dirname(config.CACHE_PATH), exist_ok=True)
+            _cache = MetadataCache(config.CACHE_PATH, config.CACHE_MAX_SIZE)
+        return _cache
@@ -10,11 +10,40 @@ _CONFIG_KEY_SONG_NAME_TYPE = 'song.name_type'
 _CONFIG_KEY_SONG_FOLDER_TYPE = 'song.folder_type'
 _CONFIG_KEY_AUDIO_QUALITY = 'download.audio_quality'
 _CONFIG_KEY_USER_COOKIE = 'auth.cookie'
+_CONFIG_KEY_DOWNLOAD_JOBS = 'download.jobs'
+_CONFIG_KEY_DOWNLOAD_HOST_LIMIT = 'download.host_limit'
+_CONFIG_KEY_DOWNLOAD_SEGMENTS = 'download.segments'
+_CONFIG_KEY_DOWNLOAD_SEGMENT_MIN_SIZE = 'download.segment_min_size'
+_CONFIG_KEY_CACHE_ENABLED = 'cache.enabled'
+_CONFIG_KEY_CACHE_MAX_SIZE = 'cache.max_size'
+_CONFIG_KEY_COVER_CACHE_SIZE = 'cover.cache_size'
+_CONFIG_KEY_COVER_CACHE_PERSIST = 'cover.persist'
+_CONFIG_KEY_LYRIC_PREFETCH_WORKERS = 'lyrics.prefetch_workers'
+_CONFIG_KEY_PLAYLIST_PAGE_SIZE = 'playlist.page_size'
+_CONFIG_KEY_RADIO_PAGE_WORKERS = 'radio.page_workers'
+_CONFIG_KEY_LIBRARY_ENABLED = 'library.enabled'
+_CONFIG_KEY_LIBRARY_SCAN_WORKERS = 'library.scan_workers'
+_CONFIG_KEY_LIBRARY_RESCAN_INTERVAL = 'library.rescan_interval'
+_CONFIG_KEY_RATE_LIMIT = 'ratelimit.{}'
+_CONFIG_KEY_RETRY_MAX_ATTEMPTS = 'retry.max_attempts'
+_CONFIG_KEY_RETRY_MAX_DELAY = 'retry.max_delay'
+_CONFIG_KEY_PIPELINE_WORKERS = 'pipeline.{}'
+_CONFIG_KEY_PIPELINE_QUEUE_SIZE = 'pipeline.queue_size'
+_CONFIG_KEY_CPU_WORKERS = 'cpu.workers'
+_CONFIG_KEY_CPU_PROCESSES = 'cpu.processes'
+_CONFIG_KEY_ENCRYPT_KEY_LIFETIME = 'encrypt.key_lifetime'
+_CONFIG_KEY_HTTP_POOL_SIZE = 'http.pool_size'
+_CONFIG_KEY_HTTP_RETRIES = 'http.retries'
+_CONFIG_KEY_HTTP_KEEP_ALIVE = 'http.keep_alive'
 
 # Base path
 _CONFIG_MAIN_PATH = os.path.join(os.path.expanduser('~'), '.ncm')
 _CONFIG_FILE_PATH = os.path.join(_CONFIG_MAIN_PATH, 'ncm.ini')
 _DEFAULT_DOWNLOAD_PATH = os.path.join(_CONFIG_MAIN_PATH, 'download')
+CACHE_PATH = os.path.join(_CONFIG_MAIN_PATH, 'cache.db')
+COVER_CACHE_DIR = os.path.join(_CONFIG_MAIN_PATH, 'covers')
+LYRIC_STORE_PATH = os.path.join(_CONFIG_MAIN_PATH, 'lyrics.db')
+LIBRARY_INDEX_PATH = os.path.join(_CONFIG_MAIN_PATH, 'library.db')
 
 # Global config value
 DOWNLOAD_HOT_MAX_DEFAULT = 50
@@ -24,6 +53,43 @@ SONG_NAME_TYPE = 1
 SONG_FOLDER_TYPE = 1
 AUDIO_QUALITY = 'flac'  # flac, 320k, 192k, 128k
 USER_COOKIE = ''
+DOWNLOAD_JOBS = 1
+DOWNLOAD_HOST_LIMIT = 4
+DOWNLOAD_SEGMENTS = 1
+DOWNLOAD_SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+CACHE_ENABLED = True
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+COVER_CACHE_SIZE = 16 * 1024 * 1024
+COVER_CACHE_PERSIST = False
+LYRIC_PREFETCH_WORKERS = 2
+PLAYLIST_PAGE_SIZE = 100
+RADIO_PAGE_WORKERS = 4
+LIBRARY_ENABLED = True
+LIBRARY_SCAN_WORKERS = 8
+LIBRARY_RESCAN_INTERVAL = 3600
+# Endpoint class => (requests per second, burst)
+RATE_LIMITS = {
+    'detail': (5, 10),
+    'url': (5, 10),
+    'lyric': (5, 10),
+    'cdn': (20, 20),
+}
+RETRY_MAX_ATTEMPTS = 5
+RETRY_MAX_DELAY = 30
+# Download stage => worker threads, the transfer stage uses DOWNLOAD_JOBS
+PIPELINE_WORKERS = {
+    'prepare': 2,
+    'resolve': 1,
+    'enrich': 2,
+    'tag': 2,
+}
+PIPELINE_QUEUE_SIZE = 4
+CPU_WORKERS = 2
+CPU_PROCESSES = True
+ENCRYPT_KEY_LIFETIME = 0
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_KEEP_ALIVE = True
 
 
 def load_config():
@@ -39,12 +105,69 @@ def load_config():
     global SONG_FOLDER_TYPE
     global AUDIO_QUALITY
     global USER_COOKIE
+    global DOWNLOAD_JOBS
+    global DOWNLOAD_HOST_LIMIT
+    global DOWNLOAD_SEGMENTS
+    global DOWNLOAD_SEGMENT_MIN_SIZE
+    global CACHE_ENABLED
+    global CACHE_MAX_SIZE
+    global COVER_CACHE_SIZE
+    global COVER_CACHE_PERSIST
+    global LYRIC_PREFETCH_WORKERS
+    global PLAYLIST_PAGE_SIZE
+    global RADIO_PAGE_WORKERS
+    global LIBRARY_ENABLED
+    global LIBRARY_SCAN_WORKERS
+    global LIBRARY_RESCAN_INTERVAL
+    global RETRY_MAX_ATTEMPTS
+    global RETRY_MAX_DELAY
+    global PIPELINE_QUEUE_SIZE
+    global CPU_WORKERS
+    global CPU_PROCESSES
+    global ENCRYPT_KEY_LIFETIME
+    global HTTP_POOL_SIZE
+    global HTTP_RETRIES
+    global HTTP_KEEP_ALIVE
 
     DOWNLOAD_HOT_MAX = cfg.getint('settings', _CONFIG_KEY_DOWNLOAD_HOT_MAX)
     DOWNLOAD_DIR = cfg.get('settings', _CONFIG_KEY_DOWNLOAD_DIR)
     SONG_NAME_TYPE = cfg.getint('settings', _CONFIG_KEY_SONG_NAME_TYPE)
     SONG_FOLDER_TYPE = cfg.getint('settings', _CONFIG_KEY_SONG_FOLDER_TYPE)
     AUDIO_QUALITY = cfg.get('settings', _CONFIG_KEY_AUDIO_QUALITY, fallback='flac')
+    DOWNLOAD_JOBS = cfg.getint('settings', _CONFIG_KEY_DOWNLOAD_JOBS, fallback=DOWNLOAD_JOBS)
+    DOWNLOAD_HOST_LIMIT = cfg.getint('settings', _CONFIG_KEY_DOWNLOAD_HOST_LIMIT, fallback=DOWNLOAD_HOST_LIMIT)
+    DOWNLOAD_SEGMENTS = cfg.getint('settings', _CONFIG_KEY_DOWNLOAD_SEGMENTS, fallback=DOWNLOAD_SEGMENTS)
+    DOWNLOAD_SEGMENT_MIN_SIZE = cfg.getint('settings', _CONFIG_KEY_DOWNLOAD_SEGMENT_MIN_SIZE,
+                                           fallback=DOWNLOAD_SEGMENT_MIN_SIZE)
+    CACHE_ENABLED = cfg.getboolean('settings', _CONFIG_KEY_CACHE_ENABLED, fallback=CACHE_ENABLED)
+    CACHE_MAX_SIZE = cfg.getint('settings', _CONFIG_KEY_CACHE_MAX_SIZE, fallback=CACHE_MAX_SIZE)
+    COVER_CACHE_SIZE = cfg.getint('settings', _CONFIG_KEY_COVER_CACHE_SIZE, fallback=COVER_CACHE_SIZE)
+    COVER_CACHE_PERSIST = cfg.getboolean('settings', _CONFIG_KEY_COVER_CACHE_PERSIST, fallback=COVER_CACHE_PERSIST)
+    LYRIC_PREFETCH_WORKERS = cfg.getint('settings', _CONFIG_KEY_LYRIC_PREFETCH_WORKERS,
+                                        fallback=LYRIC_PREFETCH_WORKERS)
+    PLAYLIST_PAGE_SIZE = cfg.getint('settings', _CONFIG_KEY_PLAYLIST_PAGE_SIZE, fallback=PLAYLIST_PAGE_SIZE)
+    RADIO_PAGE_WORKERS = cfg.getint('settings', _CONFIG_KEY_RADIO_PAGE_WORKERS, fallback=RADIO_PAGE_WORKERS)
+    LIBRARY_ENABLED = cfg.getboolean('settings', _CONFIG_KEY_LIBRARY_ENABLED, fallback=LIBRARY_ENABLED)
+    LIBRARY_SCAN_WORKERS = cfg.getint('settings', _CONFIG_KEY_LIBRARY_SCAN_WORKERS, fallback=LIBRARY_SCAN_WORKERS)
+    LIBRARY_RESCAN_INTERVAL = cfg.getint('settings', _CONFIG_KEY_LIBRARY_RESCAN_INTERVAL,
+                                         fallback=LIBRARY_RESCAN_INTERVAL)
+    for kind in RATE_LIMITS:
+        value = cfg.get('settings', _CONFIG_KEY_RATE_LIMIT.format(kind), fallback=None)
+        if value:
+            rate, _, burst = value.partition(',')
+            RATE_LIMITS[kind] = (float(rate), int(burst) if burst.strip() else RATE_LIMITS[kind][1])
+    RETRY_MAX_ATTEMPTS = cfg.getint('settings', _CONFIG_KEY_RETRY_MAX_ATTEMPTS, fallback=RETRY_MAX_ATTEMPTS)
+    RETRY_MAX_DELAY = cfg.getfloat('settings', _CONFIG_KEY_RETRY_MAX_DELAY, fallback=RETRY_MAX_DELAY)
+    for stage in PIPELINE_WORKERS:
+        PIPELINE_WORKERS[stage] = cfg.getint('settings', _CONFIG_KEY_PIPELINE_WORKERS.format(stage),
+                                             fallback=PIPELINE_WORKERS[stage])
+    PIPELINE_QUEUE_SIZE = cfg.getint('settings', _CONFIG_KEY_PIPELINE_QUEUE_SIZE, fallback=PIPELINE_QUEUE_SIZE)
+    CPU_WORKERS = cfg.getint('settings', _CONFIG_KEY_CPU_WORKERS, fallback=CPU_WORKERS)
+    CPU_PROCESSES = cfg.getboolean('settings', _CONFIG_KEY_CPU_PROCESSES, fallback=CPU_PROCESSES)
+    ENCRYPT_KEY_LIFETIME = cfg.getfloat('settings', _CONFIG_KEY_ENCRYPT_KEY_LIFETIME, fallback=ENCRYPT_KEY_LIFETIME)
+    HTTP_POOL_SIZE = cfg.getint('settings', _CONFIG_KEY_HTTP_POOL_SIZE, fallback=HTTP_POOL_SIZE)
+    HTTP_RETRIES = cfg.getint('settings', _CONFIG_KEY_HTTP_RETRIES, fallback=HTTP_RETRIES)
+    HTTP_KEEP_ALIVE = cfg.getboolean('settings', _CONFIG_KEY_HTTP_KEEP_ALIVE, fallback=HTTP_KEEP_ALIVE)
     if cfg.has_option('auth', _CONFIG_KEY_USER_COOKIE):
         USER_COOKIE = cfg.get('auth', _CONFIG_KEY_USER_COOKIE)
 
@@ -74,6 +197,166 @@ def init_config_file():
     #--------------------------------------
     {key_quality} = flac
 
+    #--------------------------------------
+    # Parallel track downloads for album,
+    # playlist, hot songs and radio, 1 means
+    # download one by one
+    #--------------------------------------
+    {key_jobs} = 1
+
+    #--------------------------------------
+    # Max concurrent requests against a
+    # single host when downloading in parallel
+    #--------------------------------------
+    {key_host_limit} = 4
+
+    #--------------------------------------
+    # Split a large audio file (e.g. flac)
+    # into N ranges downloaded in parallel,
+    # 1 means a single connection. Only
+    # files of at least segment_min_size
+    # bytes are split.
+    #--------------------------------------
+    {key_segments} = 1
+    {key_segment_min_size} = 8388608
+
+    #--------------------------------------
+    # Keep song/album/playlist info in
+    # ~/.ncm/cache.db between runs, least
+    # recently used entries are removed once
+    # it grows past max_size bytes
+    #--------------------------------------
+    {key_cache_enabled} = true
+    {key_cache_max_size} = 67108864
+
+    #--------------------------------------
+    # Resized covers kept in memory, each
+    # album cover is downloaded once per
+    # run. With persist, covers are also
+    # kept in ~/.ncm/covers between runs.
+    #--------------------------------------
+    {key_cover_cache_size} = 16777216
+    {key_cover_persist} = false
+
+    #--------------------------------------
+    # Threads fetching the lyrics of an
+    # album or playlist while its songs
+    # download. Lyrics are kept compressed
+    # in ~/.ncm/lyrics.db (needs
+    # cache.enabled) for later retags.
+    #--------------------------------------
+    {key_lyric_prefetch_workers} = 2
+
+    #--------------------------------------
+    # Song details of a playlist fetched
+    # per request (max 500). Downloads
+    # start after the first page, later
+    # pages are fetched as they're needed.
+    #--------------------------------------
+    {key_playlist_page_size} = 100
+
+    #--------------------------------------
+    # Radio pages (100 programs each)
+    # requested at a time after the first
+    # one, still within ratelimit.detail.
+    #--------------------------------------
+    {key_radio_page_workers} = 4
+
+    #--------------------------------------
+    # Index the NetEase song ids of the
+    # files under download.dir in
+    # ~/.ncm/library.db, so a song is never
+    # downloaded twice even after changing
+    # song.name_type or song.folder_type.
+    # Rescans only read the tags of new or
+    # changed files, scan_workers at a time.
+    # Downloads only rescan when the last
+    # scan is rescan_interval seconds old,
+    # files they write are indexed anyway.
+    #--------------------------------------
+    {key_library_enabled} = true
+    {key_library_scan_workers} = 8
+    {key_library_rescan_interval} = 3600
+
+    #--------------------------------------
+    # Requests per second, burst size for
+    # each kind of request. The rate drops
+    # when the server answers busy and
+    # recovers after. 0 means no limit.
+    #
+    # detail: song/album/playlist info
+    # url:    song download urls
+    # lyric:  lyrics
+    # cdn:    audio and cover downloads
+    #--------------------------------------
+    {key_rate_detail} = 5, 10
+    {key_rate_url} = 5, 10
+    {key_rate_lyric} = 5, 10
+    {key_rate_cdn} = 20, 20
+
+    #--------------------------------------
+    # Api requests failing with busy codes,
+    # timeouts or connection errors are
+    # retried with exponential backoff:
+    # max attempts and max seconds between
+    # two attempts
+    #--------------------------------------
+    {key_retry_attempts} = 5
+    {key_retry_delay} = 30
+
+    #--------------------------------------
+    # Worker threads of each download stage,
+    # a track goes through them in order and
+    # its tagging overlaps the download of
+    # the next one. download.jobs sets the
+    # audio download workers.
+    #
+    # prepare: file names, skip checks
+    # resolve: download urls
+    # enrich:  covers and lyrics
+    # tag:     writing tags into files
+    # queue_size: tracks waiting per stage
+    #--------------------------------------
+    {key_pipeline_prepare} = 2
+    {key_pipeline_resolve} = 1
+    {key_pipeline_enrich} = 2
+    {key_pipeline_tag} = 2
+    {key_pipeline_queue_size} = 4
+
+    #--------------------------------------
+    # Workers resizing covers and writing
+    # tags. With processes = true the ncm
+    # command runs them in separate
+    # processes for multi-track downloads,
+    # so they use other cores than the
+    # downloads; single songs and library
+    # callers use threads. 0 runs them in
+    # the download threads.
+    #--------------------------------------
+    {key_cpu_workers} = 2
+    {key_cpu_processes} = true
+
+    #--------------------------------------
+    # Seconds an api encryption key is
+    # reused across requests, 0 draws a new
+    # one for every request like the web
+    # client does
+    #--------------------------------------
+    {key_encrypt_key_lifetime} = 0
+
+    #--------------------------------------
+    # HTTP connection pool shared by api
+    # calls and file downloads
+    #
+    # pool_size:  connections kept per host
+    # retries:    GET retries on connection
+    #             errors and 500/502/504
+    # keep_alive: reuse connections
+    #--------------------------------------
+    {key_pool_size} = 10
+    {key_retries} = 3
+    {key_keep_alive} = true
+
     #--------------------------------------
     # Song name type, maybe one of the
     # following values:
@@ -110,6 +393,37 @@ def init_config_file():
                key_dir=_CONFIG_KEY_DOWNLOAD_DIR,
                value_dir=_DEFAULT_DOWNLOAD_PATH,
                key_quality=_CONFIG_KEY_AUDIO_QUALITY,
+               key_jobs=_CONFIG_KEY_DOWNLOAD_JOBS,
+               key_host_limit=_CONFIG_KEY_DOWNLOAD_HOST_LIMIT,
+               key_segments=_CONFIG_KEY_DOWNLOAD_SEGMENTS,
+               key_segment_min_size=_CONFIG_KEY_DOWNLOAD_SEGMENT_MIN_SIZE,
+               key_cache_enabled=_CONFIG_KEY_CACHE_ENABLED,
+               key_cache_max_size=_CONFIG_KEY_CACHE_MAX_SIZE,
+               key_cover_cache_size=_CONFIG_KEY_COVER_CACHE_SIZE,
+               key_cover_persist=_CONFIG_KEY_COVER_CACHE_PERSIST,
+               key_lyric_prefetch_workers=_CONFIG_KEY_LYRIC_PREFETCH_WORKERS,
+               key_playlist_page_size=_CONFIG_KEY_PLAYLIST_PAGE_SIZE,
+               key_radio_page_workers=_CONFIG_KEY_RADIO_PAGE_WORKERS,
+               key_library_enabled=_CONFIG_KEY_LIBRARY_ENABLED,
+               key_library_scan_workers=_CONFIG_KEY_LIBRARY_SCAN_WORKERS,
+               key_library_rescan_interval=_CONFIG_KEY_LIBRARY_RESCAN_INTERVAL,
+               key_rate_detail=_CONFIG_KEY_RATE_LIMIT.format('detail'),
+               key_rate_url=_CONFIG_KEY_RATE_LIMIT.format('url'),
+               key_rate_lyric=_CONFIG_KEY_RATE_LIMIT.format('lyric'),
+               key_rate_cdn=_CONFIG_KEY_RATE_LIMIT.format('cdn'),
+               key_retry_attempts=_CONFIG_KEY_RETRY_MAX_ATTEMPTS,
+               key_retry_delay=_CONFIG_KEY_RETRY_MAX_DELAY,
+               key_pipeline_prepare=_CONFIG_KEY_PIPELINE_WORKERS.format('prepare'),
+               key_pipeline_resolve=_CONFIG_KEY_PIPELINE_WORKERS.format('resolve'),
+               key_pipeline_enrich=_CONFIG_KEY_PIPELINE_WORKERS.format('enrich'),
+               key_pipeline_tag=_CONFIG_KEY_PIPELINE_WORKERS.format('tag'),
+               key_pipeline_queue_size=_CONFIG_KEY_PIPELINE_QUEUE_SIZE,
+               key_cpu_workers=_CONFIG_KEY_CPU_WORKERS,
+               key_cpu_processes=_CONFIG_KEY_CPU_PROCESSES,
+               key_encrypt_key_lifetime=_CONFIG_KEY_ENCRYPT_KEY_LIFETIME,
+               key_pool_size=_CONFIG_KEY_HTTP_POOL_SIZE,
+               key_retries=_CONFIG_KEY_HTTP_RETRIES,
+               key_keep_alive=_CONFIG_KEY_HTTP_KEEP_ALIVE,
                key_name_type=_CONFIG_KEY_SONG_NAME_TYPE,
                key_folder_type=_CONFIG_KEY_SONG_FOLDER_TYPE,
                key_cookie=_CONFIG_KEY_USER_COOKIE)
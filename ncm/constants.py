@@ -6,6 +6,7 @@ import string
 modulus = '00e0b509f6259df8642dbc35662901477df22677ec152b5ff68ace615bb7b725152b3ab17a876aea8a5aa76d2e417629ec4ee341f56135fccf695280104e0312ecbda92557c93870114af6c9d05c4f7f0c3685b7a46bee255932575cce10b424d813cfe4875d3e82047b97ddef52741d546b8e289dc6935b3ece0462db0a22b8e7'
 nonce = '0CoJUm6Qyw8W8jud'
 pub_key = '010001'
+user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36'
 
 def get_headers(user_cookie=None):
     """Generate headers with optional user cookie"""
@@ -22,7 +23,7 @@ def get_headers(user_cookie=None):
     return {
         'Accept': '*/*',
         'Host': 'music.163.com',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36',
+        'User-Agent': user_agent,
         'Referer': 'http://music.163.com',
         'Cookie': cookie
     }
@@ -37,6 +38,10 @@ def get_song_url(song_id):
     return 'http://music.163.com/api/song/detail/?ids=[{}]'.format(song_id)
 
 
+def get_songs_url(song_ids):
+    return 'http://music.163.com/api/song/detail/?ids=[{}]'.format(','.join(str(i) for i in song_ids))
+
+
 def get_program_url(program_id):
     return 'http://music.163.com/weapi/dj/program/detail?csrf_token='
 
@@ -50,9 +55,11 @@ def get_artist_url(artist_id):
 
 
 def get_playlist_url(playlist_id):
-    return 'http://music.163.com/api/v6/playlist/detail?id={}'.format(playlist_id)
+    # n=0: only the track ids, not the details of the first tracks
+    return 'http://music.163.com/api/v6/playlist/detail?id={}&n=0'.format(playlist_id)
 
 
 def get_radio_url(radio_id, limit=100, offset=0):
+    # asc=false: newest programs first
     return 'http://music.163.com/api/dj/program/byradio?asc=false&radioId={}&limit={}&offset={}'.format(
         radio_id, limit, offset)
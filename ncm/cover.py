@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from ncm import config
+
+
+def cover_key(cover_url):
+    """
+    Cover urls of an album only differ in their query string (e.g. ?param=...), the path holds the pic id
+    """
+    parsed = urlparse(cover_url)
+    return hashlib.sha1('{}{}'.format(parsed.netloc, parsed.path).encode('utf-8')).hexdigest()
+
+
+class CoverCache(object):
+    """
+    Resized cover bytes keyed by pic url, the least recently used ones are dropped
+    once they take more than max_size bytes. With a folder, covers are also kept
+    on disk between runs. Each cover is fetched once even when the tracks of an
+    album ask for it at the same time.
+    """
+
+    def __init__(self, max_size, folder=None):
+        super().__init__()
+        self.max_size = max_size
+        self.folder = folder
+        self.size = 0
+        self._covers = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, cover_url, fetch):
+        """
+        :param fetch: callable taking the url and returning the resized cover bytes
+        :return: cover bytes
+        """
+        key = cover_key(cover_url)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            data = self._get_memory(key)
+            if data is None:
+                data = self._read_disk(key)
+                if data is None:
+                    data = fetch(cover_url)
+                    self._write_disk(key, data)
+                self._set_memory(key, data)
+            return data
+
+    def _get_memory(self, key):
+        with self._lock:
+            data = self._covers.get(key)
+            if data is not None:
+                self._covers.move_to_end(key)
+            return data
+
+    def _set_memory(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            self._covers[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self._covers.popitem(last=False)
+                self.size -= len(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def _read_disk(self, key):
+        if self.folder is None:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write_disk(self, key, data):
+        if self.folder is None:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+_cover_cache = None
+_cover_cache_lock = threading.Lock()
+
+
+def get_cover_cache():
+    """
+    Get the process-wide cover cache, persisted to COVER_CACHE_DIR when enabled in config
+    """
+    global _cover_cache
+    with _cover_cache_lock:
+        if _cover_cache is None:
+            folder = config.COVER_CACHE_DIR if config.COVER_CACHE_PERSIST else None
+            _cover_cache = CoverCache(config.COVER_CACHE_SIZE, folder)
+        return _cover_cache
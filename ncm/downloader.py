@@ -1,16 +1,62 @@
 # -*- coding: utf-8 -*-
 
+import json
 import os
 import re
-import random
+import threading
 import time
-import requests
-from mutagen import File as MutagenFile
+from concurrent.futures import ThreadPoolExecutor
 
 from ncm import config
-from ncm.api import CloudApi
+from ncm.album import song_disc
+from ncm.api import get_api
+from ncm.api import SONG_URL_BATCH_SIZE
+from ncm.cover import get_cover_cache
+from ncm.library import get_library_index
+from ncm.lyrics import LyricFetcher
+from ncm.lyrics import get_lyric_store
 from ncm.file_util import add_metadata_to_song
+from ncm.file_util import metadata_hash
+from ncm.file_util import read_song_id
 from ncm.file_util import resize_img
+from ncm.pipeline import Pipeline
+from ncm.pipeline import Stage
+from ncm.pool import get_cpu_pool
+from ncm.pool import get_host_limiter
+from ncm.ratelimit import ENDPOINT_CDN
+from ncm.ratelimit import THROTTLE_STATUS_CODES
+from ncm.ratelimit import get_rate_limiter
+from ncm.retry import RetryPolicy
+from ncm.session import get_session
+
+# Track download status
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_SKIPPED = 'skipped'
+STATUS_UNAVAILABLE = 'unavailable'
+STATUS_RETAGGED = 'retagged'
+
+# Extensions a downloaded song may end up with
+AUDIO_EXTENSIONS = ('.flac', '.mp3', '.m4a')
+
+# Seconds to wait for the cdn to connect or send the next bytes
+DOWNLOAD_TIMEOUT = 30
+
+# Partial download file and its journal
+PART_SUFFIX = '.part'
+JOURNAL_SUFFIX = '.json'
+
+# Bytes read to detect the audio container
+AUDIO_HEADER_SIZE = 12
+
+# Read size bounds when streaming a response to disk
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Seconds between progress bar updates
+PROGRESS_INTERVAL = 0.2
+
+# Segmented download bytes between journal updates
+SEGMENT_JOURNAL_INTERVAL = 4 * 1024 * 1024
 
 
 def get_bitrate_from_quality(quality):
@@ -29,24 +75,131 @@ def get_file_extension(quality):
     return '.flac' if quality.lower() == 'flac' else '.mp3'
 
 
+class SongUrlResolver(object):
+    """
+    Resolve download urls for a list of songs in batches. A chunk is only
+    resolved when its first track asks for it, so urls don't expire while
+    earlier tracks are still downloading.
+    """
+
+    def __init__(self, api, song_ids, bit_rate, batch_size=SONG_URL_BATCH_SIZE):
+        super().__init__()
+        self.api = api
+        self.bit_rate = bit_rate
+        self._chunks = [song_ids[i:i + batch_size] for i in range(0, len(song_ids), batch_size)]
+        self._chunk_index = {song_id: i // batch_size for i, song_id in enumerate(song_ids)}
+        self._chunk_locks = [threading.Lock() for _ in self._chunks]
+        self._resolved = set()
+        self._urls = {}
+
+    def get(self, song_id):
+        """
+        :param song_id:
+        :return: (url, bit_rate), url is None when the song is not available
+        """
+        chunk_index = self._chunk_index.get(song_id)
+        if chunk_index is None:
+            return self._resolve([song_id]).get(song_id, (None, None))
+        with self._chunk_locks[chunk_index]:
+            if chunk_index not in self._resolved:
+                self._urls.update(self._resolve(self._chunks[chunk_index]))
+                self._resolved.add(chunk_index)
+        return self._urls.get(song_id, (None, None))
+
+    def refresh(self, song_id):
+        """
+        Resolve the url of one song again, e.g. after it expired before its transfer started
+        :return: (url, bit_rate), url is None when the song is not available
+        """
+        resolved = self._resolve([song_id]).get(song_id, (None, None))
+        self._urls[song_id] = resolved
+        return resolved
+
+    def _resolve(self, song_ids):
+        resolved = {}
+        urls = self.api.get_song_urls(song_ids, bit_rate=self.bit_rate)
+        for song_id in song_ids:
+            if urls.get(song_id):
+                resolved[song_id] = (urls[song_id], self.bit_rate)
+        # Fallback to lower quality if not available
+        missing = [song_id for song_id in song_ids if song_id not in resolved]
+        if missing and self.bit_rate == 999000:
+            print('FLAC not available for {} song(s), trying 320k...'.format(len(missing)))
+            urls = self.api.get_song_urls(missing, bit_rate=320000)
+            for song_id in missing:
+                if urls.get(song_id):
+                    resolved[song_id] = (urls[song_id], 320000)
+        return resolved
+
+
 def get_song_info_by_id(song_id):
-    api = CloudApi(user_cookie=config.USER_COOKIE)
-    song = api.get_song(song_id)
+    song = get_api().get_song(song_id)
     return song
 
 
 def download_song_by_id(song_id, download_folder, sub_folder=True):
     # get song info
     song = get_song_info_by_id(song_id)
-    download_song_by_song(song, download_folder, sub_folder)
+    return download_song_by_song(song, download_folder, sub_folder)
 
 
-def download_song_by_song(song, download_folder, sub_folder=True, program=False, metadata_hint=None):
-    # polite random sleep to reduce burst requests
-    time.sleep(random.uniform(0.6, 1.6))
+class TrackJob(object):
+    """
+    A song on its way through the download stages, see TRACK_STAGES
+    """
 
-    # get song info
-    api = CloudApi(user_cookie=config.USER_COOKIE)
+    def __init__(self, song, folder, file_name, program=False, metadata_hint=None, url_resolver=None,
+                 manifest=None, lyric_fetcher=None):
+        super().__init__()
+        self.song = song
+        self.folder = folder
+        self.file_name = file_name
+        self.program = program
+        self.metadata_hint = metadata_hint
+        self.url_resolver = url_resolver
+        self.manifest = manifest
+        self.lyric_fetcher = lyric_fetcher
+        self.retag = False
+        self.song_url = None
+        # Set once the audio is on disk, a retag job starts with it
+        self.file_path = None
+        self.cover_data = None
+        self.lyrics = None
+        # Set when the job leaves the pipeline
+        self.status = None
+
+    def record(self, quality=None):
+        if self.manifest is not None:
+            self.manifest.record(self.song['id'], self.file_path, quality or config.AUDIO_QUALITY,
+                                 metadata_hash(self.song, self.program, self.metadata_hint))
+
+
+def download_song_by_song(song, download_folder, sub_folder=True, program=False, metadata_hint=None,
+                          url_resolver=None, manifest=None, lyric_fetcher=None):
+    job = prepare_song(song, download_folder, sub_folder, program, metadata_hint, url_resolver, manifest,
+                       lyric_fetcher)
+    return run_track_stages(job)
+
+
+def run_track_stages(job):
+    """
+    Run all stages of a job one after another in the calling thread
+    :return: status of the job
+    """
+    for _, func in TRACK_STAGES:
+        if job.status is not None:
+            break
+        job = func(job)
+    return job.status
+
+
+def prepare_song(song, download_folder, sub_folder=True, program=False, metadata_hint=None,
+                 url_resolver=None, manifest=None, lyric_fetcher=None, redownload=False):
+    """
+    Work out where the song goes, and skip it if it is already there
+    :param redownload: download the song even if a file of it is found
+    :return: TrackJob
+    """
     song_id = song['id']
     song_name = format_string(song['name'])
     if program:
@@ -82,13 +235,7 @@ def download_song_by_song(song, download_folder, sub_folder=True, program=False,
     if track_number is None and not program:
         track_number = song.get('no')
     if disc_total is not None and disc_number is None and not program:
-        disc_raw = song.get('disc') or song.get('cd')
-        if isinstance(disc_raw, str):
-            parts = disc_raw.split('/')
-            if parts and parts[0].isdigit():
-                disc_number = int(parts[0])
-        elif isinstance(disc_raw, int):
-            disc_number = disc_raw
+        disc_number = song_disc(song)[0]
     try:
         disc_total_int = int(disc_total) if disc_total is not None else None
         disc_number_int = int(disc_number) if disc_number is not None else None
@@ -111,96 +258,537 @@ def download_song_by_song(song, download_folder, sub_folder=True, program=False,
     else:
         song_download_folder = download_folder
 
-    # download song with quality fallback
-    song_url = None
-    if program:
-        song_url = api.get_program_url(song, level="standard")
+    job = TrackJob(song, song_download_folder, song_file_name, program, metadata_hint, url_resolver, manifest,
+                   lyric_fetcher)
+
+    # skip before asking for a download url if the song is already on disk
+    existing_file_path = None if redownload else _find_downloaded_file(song_download_folder, song_file_name,
+                                                                       song_id, manifest)
+    if existing_file_path:
+        print('File already downloaded:', os.path.basename(existing_file_path))
+        job.file_path = existing_file_path
+        # A file found by the library index may belong to another folder, keep it out of this manifest
+        if manifest is not None and manifest.get(song_id) is None and manifest.owns(existing_file_path):
+            job.record()
+        job.status = STATUS_SKIPPED
+    elif lyric_fetcher is not None and not program:
+        # Needed once the audio is downloaded
+        lyric_fetcher.prefetch([song_id])
+    return job
+
+
+def prepare_retag(song, song_file_path, program=False, metadata_hint=None, manifest=None, lyric_fetcher=None):
+    """
+    A job rewriting the tags of an already downloaded song, e.g. after its metadata changed
+    :return: TrackJob
+    """
+    job = TrackJob(song, os.path.dirname(song_file_path), os.path.basename(song_file_path), program,
+                   metadata_hint, manifest=manifest, lyric_fetcher=lyric_fetcher)
+    job.file_path = song_file_path
+    job.retag = True
+    return job
+
+
+def resolve_track(job):
+    """
+    Stage 1: get the download url
+    """
+    if job.file_path is not None:
+        return job
+    api = get_api()
+    song_id = job.song['id']
+    if job.program:
+        job.song_url = api.get_program_url(job.song, level="standard")
+    elif job.url_resolver:
+        job.song_url, bitrate = job.url_resolver.get(song_id)
+        if job.song_url and bitrate != job.url_resolver.bit_rate:
+            # Update filename to .mp3 if we fallback
+            job.file_name = job.file_name.replace('.flac', '.mp3')
     else:
         # Get bitrate from config
         bitrate = get_bitrate_from_quality(config.AUDIO_QUALITY)
-        song_url = api.get_song_url(song_id, bit_rate=bitrate)
+        job.song_url = api.get_song_url(song_id, bit_rate=bitrate)
 
         # Fallback to lower quality if not available
-        if song_url is None and bitrate == 999000:
+        if job.song_url is None and bitrate == 999000:
             print('FLAC not available, trying 320k...')
-            song_url = api.get_song_url(song_id, bit_rate=320000)
-            if song_url:
+            job.song_url = api.get_song_url(song_id, bit_rate=320000)
+            if job.song_url:
                 # Update filename to .mp3 if we fallback
-                song_file_name = song_file_name.replace('.flac', '.mp3')
+                job.file_name = job.file_name.replace('.flac', '.mp3')
 
-    if song_url is None:
-        print('Song <<{}>> is not available due to copyright issue!'.format(song_name))
-        return
-    is_already_download = download_file(song_url, song_file_name, song_download_folder)
-    if is_already_download:
-        print('Mp3 file already download:', song_file_name)
-        return
+    if job.song_url is None:
+        print('Song <<{}>> is not available due to copyright issue!'.format(format_string(job.song['name'])))
+        job.status = STATUS_UNAVAILABLE
+    return job
+
+
+def transfer_track(job):
+    """
+    Stage 2: download the audio file
+    """
+    if job.file_path is not None:
+        return job
+    try:
+        song_file_path = download_file(job.song_url, job.file_name, job.folder, segments=config.DOWNLOAD_SEGMENTS,
+                                       audio=True)
+    except IOError as e:
+        # Batch resolved urls are signed and may expire before a late transfer starts
+        if job.url_resolver is None or getattr(getattr(e, 'response', None), 'status_code', None) != 403:
+            raise
+        print('Download url of {} expired, resolving it again'.format(job.file_name))
+        song_url, bitrate = job.url_resolver.refresh(job.song['id'])
+        if song_url is None:
+            raise
+        job.song_url = song_url
+        if bitrate != job.url_resolver.bit_rate:
+            job.file_name = job.file_name.replace('.flac', '.mp3')
+        song_file_path = download_file(job.song_url, job.file_name, job.folder,
+                                       segments=config.DOWNLOAD_SEGMENTS, audio=True)
+    if song_file_path is None:
+        print('Mp3 file already download:', job.file_name)
+        if job.lyric_fetcher is not None:
+            job.lyric_fetcher.discard(job.song['id'])
+        job.file_path = os.path.join(job.folder, job.file_name)
+        job.record()
+        job.status = STATUS_SKIPPED
+        return job
+    job.file_name = os.path.basename(song_file_path)
+    job.file_path = song_file_path
+    return job
+
+
+def enrich_track(job):
+    """
+    Stage 3: download the cover and lyrics
+    """
+    song = job.song
+    song_id = song['id']
 
     # download cover
-    if program:
+    if job.program:
         cover_url = song['coverUrl']
     else:
         cover_url = song['album']['blurPicUrl']
 
     if cover_url is None:
-        if program:
+        if job.program:
             cover_url = song['mainSong']['album']['picUrl']
         else:
             cover_url = song['album']['picUrl']
-    cover_file_name = 'cover_{}.jpg'.format(song_id)
-    download_file(cover_url, cover_file_name, song_download_folder)
-
-    # resize cover
-    resize_img(os.path.join(song_download_folder, cover_file_name))
-
-    # detect actual audio format; rename if server returned non-FLAC when requested
-    song_file_path = os.path.join(song_download_folder, song_file_name)
-    actual_ext = _detect_audio_extension(song_file_path)
-    if actual_ext and actual_ext != os.path.splitext(song_file_name)[1].lower():
-        new_song_file_name = os.path.splitext(song_file_name)[0] + actual_ext
-        new_song_file_path = os.path.join(song_download_folder, new_song_file_name)
-        os.rename(song_file_path, new_song_file_path)
-        print('Detected actual format {}, renamed file to {}'.format(actual_ext, new_song_file_name))
-        song_file_name = new_song_file_name
-        song_file_path = new_song_file_path
-    elif not actual_ext:
-        print('Warning: unable to detect audio format for {}, proceeding with current extension'.format(song_file_name))
+    try:
+        job.cover_data = get_cover_cache().get(cover_url, _fetch_cover)
+    except IOError as e:
+        # Like a missing lyric, the file is tagged without it
+        print('Cover not available for {}: {}'.format(song_id, e))
 
     # fetch lyric for richer metadata (programs usually do not provide lyrics)
-    lyrics = None if program else api.get_song_lyrics(song_id)
+    if not job.program:
+        lyric_fetcher = job.lyric_fetcher or LyricFetcher(get_api(), get_lyric_store())
+        job.lyrics = lyric_fetcher.get(song_id)
+    return job
 
-    # add metadata for song
-    cover_file_path = os.path.join(song_download_folder, cover_file_name)
-    add_metadata_to_song(song_file_path, cover_file_path, song, program, lyrics, metadata_hint)
 
-    # delete cover file
-    os.remove(cover_file_path)
+def tag_track(job):
+    """
+    Stage 4: write the metadata, cover and lyrics into the file
+    """
+    get_cpu_pool().run(add_metadata_to_song, job.file_path, job.cover_data, job.song, job.program, job.lyrics,
+                       job.metadata_hint)
+    library = get_library_index()
+    if library is not None:
+        library.add(job.file_path, job.song['id'])
+
+    if job.retag:
+        # Keep the quality the file was downloaded with
+        job.record(job.manifest.get(job.song['id'])['quality'] if job.manifest is not None else None)
+        job.status = STATUS_RETAGGED
+    else:
+        job.record()
+        job.status = STATUS_DOWNLOADED
+    return job
 
 
-def download_file(file_url, file_name, folder):
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-    file_path = os.path.join(folder, file_name)
+def _fetch_cover(cover_url):
+    """
+    Download a cover into memory and resize it
+    :return: cover bytes
+    """
+    with get_host_limiter().acquire(cover_url):
+        response = _cdn_request('GET', cover_url)
+        response.raise_for_status()
+        cover_data = response.content
+    return get_cpu_pool().run(resize_img, cover_data)
+
+
+# Stage name => function, in pipeline order
+TRACK_STAGES = (
+    ('resolve', resolve_track),
+    ('transfer', transfer_track),
+    ('enrich', enrich_track),
+    ('tag', tag_track),
+)
+
+
+def create_track_pipeline(jobs=1):
+    """
+    Pipeline turning (name, callable returning a TrackJob) tasks into downloaded and tagged files
+    :param jobs: transfer workers, the other stages use the pipeline.* settings
+    """
+    stages = [Stage('prepare', lambda prepare: prepare(), config.PIPELINE_WORKERS['prepare'],
+                    config.PIPELINE_QUEUE_SIZE)]
+    for name, func in TRACK_STAGES:
+        workers = jobs if name == 'transfer' else config.PIPELINE_WORKERS[name]
+        stages.append(Stage(name, func, workers, config.PIPELINE_QUEUE_SIZE))
+    return Pipeline(stages)
 
-    response = requests.get(file_url, stream=True)
-    length_header = response.headers.get('Content-Length')
-    length = int(length_header) if length_header else None
 
-    if os.path.exists(file_path):
+def _find_downloaded_file(folder, song_file_name, song_id, manifest=None):
+    """
+    Find an intact file of the song recorded in the manifest, a file at the expected
+    path, under any audio extension, whose id tag matches the song, or any file of
+    the song in the library index, whatever its name and folder
+    :return: file path, None if the song still has to be downloaded
+    """
+    entry = manifest.get(song_id) if manifest is not None else None
+    if entry and manifest.is_intact(entry):
+        return manifest.file_path(entry)
+    base_name = os.path.splitext(song_file_name)[0]
+    for extension in AUDIO_EXTENSIONS:
+        file_path = os.path.join(folder, base_name + extension)
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0 and read_song_id(file_path) == song_id:
+            return file_path
+    library = get_library_index()
+    if library is not None:
+        library.ensure_scanned(config.DOWNLOAD_DIR)
+        return library.find(song_id)
+    return None
+
+
+def download_file(file_url, file_name, folder, segments=1, audio=False):
+    """
+    Download a file into folder, resuming a previous partial download when possible.
+    Bytes go to '<file_name>.part', described by a '<file_name>.part.json' journal,
+    and the file is renamed to its final name once complete.
+    :param segments: fetch a large file over this many parallel range requests
+    :param audio: pick the extension of the final name from the container in the first bytes
+    :return: path of the downloaded file, None if the file was already downloaded
+    """
+    # Parallel tracks of a new album create the same folder
+    os.makedirs(folder, exist_ok=True)
+    file_path = os.path.join(folder, file_name)
+    part_path = file_path + PART_SUFFIX
+    journal_path = part_path + JOURNAL_SUFFIX
+
+    journal = _read_journal(journal_path) if os.path.exists(part_path) else None
+    if journal and journal.get('segments'):
+        SegmentedDownload(file_url, file_name, part_path, journal_path, journal).run()
+        return _finish_part(part_path, file_path, journal_path, audio)
+    offset = os.path.getsize(part_path) if journal else 0
+    request_headers = {}
+    if offset:
+        request_headers['Range'] = 'bytes={}-'.format(offset)
+        # Server sends the whole file instead if it changed since the journal was written
+        request_headers['If-Range'] = journal.get('etag') or journal['last_modified']
+
+    if not offset and os.path.exists(file_path):
+        # Compare with a HEAD request, instead of opening a transfer we may not need
+        length = _head_length(file_url)
         if length and os.path.getsize(file_path) >= length:
             print('File already exists, skip download:', file_name)
-            return True
-    progress = ProgressBar(file_name, length) if length else None
+            return None
+
+    restart = False
+    with get_host_limiter().acquire(file_url), \
+            _cdn_request('GET', file_url, headers=request_headers, stream=True) as response:
+        if response.status_code == 416 and offset and offset == journal['length']:
+            # Partial file is already complete
+            return _finish_part(part_path, file_path, journal_path, audio)
+        if response.status_code == 416 and offset:
+            # Stale partial file, start over next time
+            os.remove(part_path)
+        response.raise_for_status()
+        length = _get_total_length(response)
+
+        if os.path.exists(file_path):
+            if length and os.path.getsize(file_path) >= length:
+                print('File already exists, skip download:', file_name)
+                return None
+
+        if response.status_code == 206 and length != journal['length']:
+            # Remote file changed but the server ignored If-Range
+            restart = True
+        elif not offset and segments > 1 and _can_segment(response, length):
+            journal = {
+                'url': file_url,
+                'length': length,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'segments': _split_segments(length, segments)
+            }
+        else:
+            if response.status_code != 206:
+                offset = 0
+            if offset:
+                print('Resume download {} from {} bytes'.format(file_name, offset))
+            else:
+                _write_journal(journal_path, {
+                    'url': file_url,
+                    'length': length,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')
+                })
+            show_progress = _write_response(response, part_path, offset, file_name, length)
+
+    if restart:
+        os.remove(part_path)
+        os.remove(journal_path)
+        return download_file(file_url, file_name, folder, segments, audio)
+    if journal and journal.get('segments'):
+        SegmentedDownload(file_url, file_name, part_path, journal_path, journal).run()
+        file_path = _finish_part(part_path, file_path, journal_path, audio)
+        print('Downloaded {} (size: {} bytes, {} segments)'.format(os.path.basename(file_path), length,
+                                                                 len(journal['segments'])))
+        return file_path
+    if length and os.path.getsize(part_path) < length:
+        raise IOError('Incomplete download {}: {} of {} bytes'.format(file_name, os.path.getsize(part_path), length))
+    file_path = _finish_part(part_path, file_path, journal_path, audio)
+    if not show_progress:
+        print('Downloaded {} (size: {} bytes)'.format(os.path.basename(file_path), os.path.getsize(file_path)))
+    return file_path
+
+
+def _write_response(response, part_path, offset, file_name, length):
+    """
+    Stream the response body into the partial file, appending after offset bytes
+    :return: whether a progress bar was shown
+    """
+    # Progress bars of parallel downloads would overwrite each other
+    progress = ProgressBar(file_name, length) if length and config.DOWNLOAD_JOBS <= 1 else None
+    if progress and offset:
+        progress.refresh(offset)
+
+    with open(part_path, 'ab' if offset else 'wb') as file:
+        for buffer in iter_response_chunks(response):
+            file.write(buffer)
+            if progress:
+                progress.refresh(len(buffer))
+    return progress is not None
+
+
+def iter_response_chunks(response):
+    """
+    Yield the response body as memoryviews of one reused buffer, which stays valid
+    until the next chunk is read. The read size starts at MIN_CHUNK_SIZE and doubles
+    up to MAX_CHUNK_SIZE while reads keep filling it.
+    """
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        # Raw reads skip decompression
+        yield from response.iter_content(chunk_size=MIN_CHUNK_SIZE)
+        return
+    buffer = memoryview(bytearray(MAX_CHUNK_SIZE))
+    size = MIN_CHUNK_SIZE
+    while True:
+        count = response.raw.readinto(buffer[:size])
+        if not count:
+            break
+        yield buffer[:count]
+        if count == size and size < MAX_CHUNK_SIZE:
+            size *= 2
+
+
+def _finish_part(part_path, file_path, journal_path, audio=False):
+    """
+    Move the complete partial file to its final name
+    :param audio: replace the extension with the one of the container found in the first bytes
+    :return: final file path
+    """
+    if audio:
+        with open(part_path, 'rb') as file:
+            actual_ext = _detect_audio_extension(file.read(AUDIO_HEADER_SIZE))
+        base_path, ext = os.path.splitext(file_path)
+        if actual_ext and actual_ext != ext.lower():
+            file_path = base_path + actual_ext
+            print('Detected actual format {}, saved as {}'.format(actual_ext, os.path.basename(file_path)))
+        elif not actual_ext:
+            print('Warning: unable to detect audio format for {}, proceeding with current extension'.format(
+                os.path.basename(file_path)))
+    os.replace(part_path, file_path)
+    os.remove(journal_path)
+    return file_path
+
+
+def _can_segment(response, length):
+    return (response.status_code == 200 and length and length >= config.DOWNLOAD_SEGMENT_MIN_SIZE
+            and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            and (response.headers.get('ETag') or response.headers.get('Last-Modified')))
+
+
+def _split_segments(length, count):
+    """
+    Split [0, length) into count ranges of [start, end, done_bytes]
+    """
+    size = -(-length // count)
+    return [[start, min(start + size, length), 0] for start in range(0, length, size)]
+
+
+class SegmentedDownload(object):
+    """
+    Fetch the byte ranges listed in a journal in parallel, each written at its own
+    offset of a preallocated partial file. Progress is saved to the journal so an
+    interrupted download only fetches the missing part of each range.
+    """
+
+    def __init__(self, file_url, file_name, part_path, journal_path, journal):
+        super().__init__()
+        self.file_url = file_url
+        self.file_name = file_name
+        self.part_path = part_path
+        self.journal_path = journal_path
+        self.journal = journal
+        self._lock = threading.Lock()
+        self._progress = None
+
+    def run(self):
+        length = self.journal['length']
+        segments = self.journal['segments']
+        if (not os.path.exists(self.journal_path) or not os.path.exists(self.part_path)
+                or os.path.getsize(self.part_path) != length):
+            # New journal, or a part file it doesn't describe: start from an empty file of the full length
+            for segment in segments:
+                segment[2] = 0
+            with open(self.part_path, 'wb') as file:
+                file.truncate(length)
+            _write_journal(self.journal_path, self.journal)
+        if config.DOWNLOAD_JOBS <= 1:
+            self._progress = ProgressBar(self.file_name, length)
+            self._progress.refresh(sum(segment[2] for segment in segments))
+
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(self._fetch, segment) for segment in segments if segment[2] < segment[1] - segment[0]]
+            for future in futures:
+                future.result()
+        _write_journal(self.journal_path, self.journal)
+        if os.path.getsize(self.part_path) != length:
+            raise IOError('Incomplete download {}: {} of {} bytes'.format(
+                self.file_name, os.path.getsize(self.part_path), length))
+
+    def _fetch(self, segment):
+        start, end, _ = segment
+        headers = {
+            'Range': 'bytes={}-{}'.format(start + segment[2], end - 1),
+            'If-Range': self.journal.get('etag') or self.journal['last_modified']
+        }
+        with get_host_limiter().acquire(self.file_url), \
+                _cdn_request('GET', self.file_url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                # File changed since the journal was written, drop it and let the next run start over
+                _remove_files(self.journal_path, self.part_path)
+                raise IOError('Remote file changed during segmented download: {}'.format(self.file_name))
+            unsaved = 0
+            with open(self.part_path, 'r+b', buffering=0) as file:
+                for buffer in iter_response_chunks(response):
+                    _pwrite(file, buffer, start + segment[2])
+                    with self._lock:
+                        segment[2] += len(buffer)
+                        unsaved += len(buffer)
+                        if self._progress:
+                            self._progress.refresh(len(buffer))
+                        if unsaved >= SEGMENT_JOURNAL_INTERVAL:
+                            unsaved = 0
+                            _write_journal(self.journal_path, self.journal)
+        if segment[2] < end - start:
+            raise IOError('Incomplete segment {}-{} of {}'.format(start, end, self.file_name))
+
+
+def _remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            # Already removed by another segment
+            pass
+
+
+def _pwrite(file, data, offset):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(file.fileno(), data, offset)
+    else:
+        file.seek(offset)
+        file.write(data)
 
-    with open(file_path, 'wb') as file:
-        for buffer in response.iter_content(chunk_size=1024):
-            if buffer:
-                file.write(buffer)
-                if progress:
-                    progress.refresh(len(buffer))
-    if not progress:
-        print('Downloaded {} (size: {} bytes)'.format(file_name, os.path.getsize(file_path)))
-    return False
+
+def _cdn_request(method, file_url, **kwargs):
+    """
+    Send a request to the cdn through the shared session, paced by the cdn rate limiter.
+    Busy answers (429, 503) are retried with the retry policy, honouring Retry-After;
+    the session's own retries leave them to us.
+    :return: response, the last busy one when the retry policy gave up
+    """
+    rate_limiter = get_rate_limiter()
+    retry_policy = RetryPolicy()
+    attempt = 0
+    while True:
+        rate_limiter.acquire(ENDPOINT_CDN)
+        response = get_session().request(method, file_url, timeout=DOWNLOAD_TIMEOUT, **kwargs)
+        busy = response.status_code in THROTTLE_STATUS_CODES
+        rate_limiter.report(ENDPOINT_CDN, busy)
+        attempt += 1
+        if not busy or not retry_policy.should_retry(attempt):
+            return response
+        retry_after = response.headers.get('Retry-After', '')
+        response.close()
+        delay = retry_policy.backoff(attempt)
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), retry_policy.max_delay))
+        time.sleep(delay)
+
+
+def _head_length(file_url):
+    """
+    :return: Content-Length reported by a HEAD request, None if unknown
+    """
+    try:
+        with get_host_limiter().acquire(file_url):
+            response = _cdn_request('HEAD', file_url, allow_redirects=True)
+    except IOError:
+        return None
+    if response.status_code != 200:
+        return None
+    return _get_total_length(response)
+
+
+def _get_total_length(response):
+    """
+    Full length of the remote file, from Content-Range for partial responses
+    """
+    if response.status_code == 206:
+        content_range = response.headers.get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length_header = response.headers.get('Content-Length')
+    return int(length_header) if length_header else None
+
+
+def _read_journal(journal_path):
+    """
+    Load a partial download journal, None if missing or unusable for resuming
+    """
+    try:
+        with open(journal_path, 'r', encoding='utf-8') as journal_file:
+            journal = json.load(journal_file)
+    except (IOError, ValueError):
+        return None
+    # Without a validator we can't tell whether the remote file changed
+    if not journal.get('length') or not (journal.get('etag') or journal.get('last_modified')):
+        return None
+    return journal
+
+
+def _write_journal(journal_path, journal):
+    with open(journal_path, 'w', encoding='utf-8') as journal_file:
+        json.dump(journal, journal_file)
 
 
 class ProgressBar(object):
@@ -209,9 +797,9 @@ class ProgressBar(object):
         super().__init__()
         self.file_name = file_name
         self.count = 0
-        self.prev_count = 0
+        self.prev_time = 0
         self.total = total
-        self.end_str = '\r'
+        self.finished = False
 
     def __get_info(self):
         percent = (self.count / self.total * 100) if self.total else 0
@@ -222,14 +810,17 @@ class ProgressBar(object):
 
     def refresh(self, count):
         self.count += count
-        # Update progress if down size > 10k
-        if (self.count - self.prev_count) > 10240:
-            self.prev_count = self.count
-            print(self.__get_info(), end=self.end_str)
         # Finish downloading
         if self.total and self.count >= self.total:
-            self.end_str = '\n'
-            print(self.__get_info(), end=self.end_str)
+            if not self.finished:
+                self.finished = True
+                print(self.__get_info())
+            return
+        # Update progress at most every PROGRESS_INTERVAL seconds
+        now = time.monotonic()
+        if now - self.prev_time >= PROGRESS_INTERVAL:
+            self.prev_time = now
+            print(self.__get_info(), end='\r')
 
 
 def format_string(string):
@@ -239,19 +830,19 @@ def format_string(string):
     return re.sub(r'[\\/:*?"<>|\t]', ' ', string)
 
 
-def _detect_audio_extension(file_path):
-    """Detect audio container and return proper extension (e.g. '.flac', '.mp3')."""
-    try:
-        audio = MutagenFile(file_path)
-    except Exception:
-        return None
-    if audio is None:
-        return None
-    name = audio.__class__.__name__.lower()
-    if 'flac' in name:
+def _detect_audio_extension(head):
+    """
+    Detect the audio container from the first bytes of a file
+    :param head: at least AUDIO_HEADER_SIZE bytes when the file is that large
+    :return: proper extension (e.g. '.flac', '.mp3'), None if unknown
+    """
+    if head.startswith(b'fLaC'):
         return '.flac'
-    if 'mp3' in name:
+    if head.startswith(b'ID3'):
+        return '.mp3'
+    # MPEG audio frame sync, layer bits 00 would be AAC in ADTS
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0 and head[1] & 0x06:
         return '.mp3'
-    if 'mp4' in name or 'm4a' in name:
+    if head[4:8] == b'ftyp':
         return '.m4a'
     return None
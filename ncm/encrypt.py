@@ -4,34 +4,86 @@ import os
 import base64
 import json
 import binascii
-from Cryptodome.Cipher import AES
+import threading
+import time
 
+from ncm import config
 from ncm.constants import modulus, nonce, pub_key
 
+_IV = b'0102030405060708'
 
-def encrypted_request(text):
-    text = json.dumps(text)
-    sec_key = create_secret_key(16)
-    enc_text = aes_encrypt(aes_encrypt(text, nonce), sec_key.decode('utf-8'))
-    enc_sec_key = rsa_encrypt(sec_key, pub_key, modulus)
-    data = {'params': enc_text, 'encSecKey': enc_sec_key}
-    return data
 
+class RequestEncryptor(object):
+    """
+    Encrypt api parameters the way the web client does: AES-CBC with the fixed
+    nonce, then again with a random secret key, which is sent RSA encrypted as
+    encSecKey. The RSA constants are parsed once, and with key_lifetime > 0 a
+    secret key and its encSecKey are reused for that many seconds.
+    """
+
+    def __init__(self, key_lifetime=0):
+        super().__init__()
+        self.key_lifetime = key_lifetime
+        self._nonce = nonce.encode('utf-8')
+        self._exponent = int(pub_key, 16)
+        self._modulus = int(modulus, 16)
+        self._lock = threading.Lock()
+        self._sec_key = None
+        self._enc_sec_key = None
+        self._expires_at = 0
+
+    def encrypt(self, params):
+        """
+        :param params: request parameters, json serializable
+        :return: form data with 'params' and 'encSecKey'
+        """
+        sec_key, enc_sec_key = self._get_secret_key()
+        text = json.dumps(params).encode('utf-8')
+        enc_text = _aes_encrypt(base64.b64encode(_aes_encrypt(text, self._nonce)), sec_key)
+        return {'params': base64.b64encode(enc_text).decode('ascii'), 'encSecKey': enc_sec_key}
 
-def aes_encrypt(text, sec_key):
-    pad = 16 - len(text) % 16
-    text = text + chr(pad) * pad
-    encryptor = AES.new(sec_key.encode('utf-8'), AES.MODE_CBC, b'0102030405060708')
-    cipher_text = encryptor.encrypt(text.encode('utf-8'))
-    cipher_text = base64.b64encode(cipher_text).decode('utf-8')
-    return cipher_text
+    def _get_secret_key(self):
+        if self.key_lifetime <= 0:
+            sec_key = create_secret_key(16)
+            return sec_key, self._rsa_encrypt(sec_key)
+        with self._lock:
+            now = time.monotonic()
+            if self._sec_key is None or now >= self._expires_at:
+                self._sec_key = create_secret_key(16)
+                self._enc_sec_key = self._rsa_encrypt(self._sec_key)
+                self._expires_at = now + self.key_lifetime
+            return self._sec_key, self._enc_sec_key
 
+    def _rsa_encrypt(self, sec_key):
+        rs = pow(int.from_bytes(sec_key[::-1], 'big'), self._exponent, self._modulus)
+        return format(rs, 'x').zfill(256)
 
-def rsa_encrypt(text, public_key, p_modulus):
-    text = text[::-1]
-    rs = pow(int(binascii.hexlify(text), 16), int(public_key, 16), int(p_modulus, 16))
-    return format(rs, 'x').zfill(256)
+
+def _aes_encrypt(data, key):
+    from Cryptodome.Cipher import AES
+
+    pad = 16 - len(data) % 16
+    return AES.new(key, AES.MODE_CBC, _IV).encrypt(data + bytes((pad,)) * pad)
 
 
 def create_secret_key(size):
-    return binascii.hexlify(os.urandom(size))[:16]
+    return binascii.hexlify(os.urandom(size))[:size]
+
+
+_encryptor = None
+_encryptor_lock = threading.Lock()
+
+
+def get_encryptor():
+    """
+    Get the process-wide encryptor, reusing secret keys for encrypt.key_lifetime seconds
+    """
+    global _encryptor
+    with _encryptor_lock:
+        if _encryptor is None:
+            _encryptor = RequestEncryptor(config.ENCRYPT_KEY_LIFETIME)
+        return _encryptor
+
+
+def encrypted_request(text):
+    return get_encryptor().encrypt(text)
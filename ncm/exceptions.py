@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+class NcmError(Exception):
+    """
+    Base class of the errors raised by ncm
+    """
+
+
+class ApiError(NcmError):
+    """
+    The api answered with a code other than 200
+    """
+
+    def __init__(self, code, url, message=None):
+        super().__init__(message or 'Return code {} when request {}'.format(code, url))
+        self.code = code
+        self.url = url
+
+
+class RetryExhaustedError(NcmError):
+    """
+    A request kept failing with busy responses or network errors until the retry policy gave up
+    """
+
+    def __init__(self, url, attempts, cause=None):
+        super().__init__('Gave up on {} after {} attempts: {}'.format(url, attempts, cause))
+        self.url = url
+        self.attempts = attempts
+        self.cause = cause
+
+
+class CircuitOpenError(NcmError):
+    """
+    Requests to an endpoint class are refused for a while after it kept failing
+    """
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__('Too many failed {} requests, paused for {:.0f} more seconds'.format(endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
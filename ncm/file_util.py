@@ -1,45 +1,54 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
+import json
 import os
 from datetime import datetime
 
-from mutagen.flac import FLAC, Picture
-from mutagen.mp3 import MP3, HeaderNotFoundError
-from mutagen.id3 import (
-    ID3,
-    APIC,
-    COMM,
-    TCOM,
-    TCON,
-    TDRC,
-    TPE1,
-    TPE2,
-    TIT2,
-    TALB,
-    TPOS,
-    TRCK,
-    TXXX,
-    USLT,
-    error,
-)
-from PIL import Image
-
-
-def resize_img(file_path, max_size=(640, 640), quality=90):
+from ncm.album import song_disc
+
+# mutagen and Pillow are imported by the functions using them, most imports of
+# this module only need metadata_hash
+
+# Tag holding the NetEase song id, TXXX description for ID3, vorbis comment key for FLAC
+SONG_ID_TAG = 'NCM_ID'
+
+# Free bytes reserved after the tags, so a later retag with a new cover or lyrics
+# still fits in place; more than TAG_MAX_PADDING left over is given back
+TAG_PADDING = 64 * 1024
+TAG_MAX_PADDING = 256 * 1024
+
+# Bytes after the ID3v2 tag searched for the first MPEG frame
+MPEG_SYNC_WINDOW = 4096
+
+
+def resize_img(data, max_size=(640, 640), quality=90):
+    """
+    Shrink an image to fit in max_size
+    :param data: image bytes
+    :return: jpeg bytes, or data itself when it is small enough or not an image
+    """
+    from PIL import Image
+
     try:
-        img = Image.open(file_path)
+        img = Image.open(io.BytesIO(data))
     except IOError:
-        print('Can\'t open image:', file_path)
-        return
+        print('Can\'t open image')
+        return data
 
-    if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        img = img.convert('RGB')
-        img.save(file_path, quality=quality)
+    if img.size[0] <= max_size[0] and img.size[1] <= max_size[1]:
+        return data
+    # Let the jpeg decoder scale down by 1/2, 1/4 or 1/8 while decoding, no-op for other formats
+    img.draft('RGB', max_size)
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.convert('RGB').save(output, 'JPEG', quality=quality)
+    return output.getvalue()
 
 
-def add_metadata_to_song(file_path, cover_path, song, is_program=False, lyrics=None, metadata_hint=None):
-    """Write metadata (ID3 or Vorbis) and embed cover art."""
+def add_metadata_to_song(file_path, cover_data, song, is_program=False, lyrics=None, metadata_hint=None):
+    """Write metadata (ID3 or Vorbis) and embed cover art given as image bytes."""
 
     metadata = _build_metadata(song, is_program, lyrics, metadata_hint)
     print('Writing metadata -> title: {title}, artists: {artists}, album: {album}, track: {track}/{track_total}, disc: {disc}/{disc_total}, has_lyrics: {has_lyrics}, has_translation: {has_translation}'.format(
@@ -56,9 +65,154 @@ def add_metadata_to_song(file_path, cover_path, song, is_program=False, lyrics=N
     extension = os.path.splitext(file_path)[1].lower()
 
     if extension == '.flac':
-        _add_flac_metadata(file_path, cover_path, metadata)
+        _add_flac_metadata(file_path, cover_data, metadata)
+    elif extension == '.mp3':
+        _add_id3_metadata(file_path, cover_data, metadata)
     else:
-        _add_id3_metadata(file_path, cover_path, metadata)
+        # An ID3 block in front of e.g. an m4a file breaks its container
+        print('Skip writing metadata, unsupported file type: {}'.format(file_path))
+
+
+class _UnsupportedTag(Exception):
+    """
+    A tag layout read_song_id doesn't walk itself, e.g. unsynchronised ID3
+    """
+
+
+def read_song_id(file_path):
+    """
+    Read the NetEase song id written by add_metadata_to_song. Only the tag headers
+    are read, covers and audio are seeked over; tag layouts the reader doesn't walk
+    are left to mutagen
+    :return: song id<int>, None if the file has no id tag or can't be read
+    """
+    try:
+        with open(file_path, 'rb') as song_file:
+            head = song_file.read(10)
+            if head[:4] == b'fLaC':
+                song_file.seek(4)
+                value = _read_flac_song_id(song_file)
+            elif head[:3] == b'ID3':
+                value = _read_id3_song_id(song_file, head)
+            else:
+                return None
+    except _UnsupportedTag:
+        value = _read_song_id_mutagen(file_path)
+    except (OSError, ValueError):
+        return None
+    if not value or not value.isdigit():
+        return None
+    return int(value)
+
+
+def _read_flac_song_id(song_file):
+    key = SONG_ID_TAG.lower().encode('ascii') + b'='
+    while True:
+        header = song_file.read(4)
+        if len(header) < 4:
+            return None
+        size = int.from_bytes(header[1:4], 'big')
+        if header[0] & 0x7F == 4:
+            # VORBIS_COMMENT: vendor string, then count and length prefixed 'KEY=value' comments
+            data = song_file.read(size)
+            offset = 4 + int.from_bytes(data[0:4], 'little')
+            count = int.from_bytes(data[offset:offset + 4], 'little')
+            offset += 4
+            for _ in range(count):
+                length = int.from_bytes(data[offset:offset + 4], 'little')
+                comment = data[offset + 4:offset + 4 + length]
+                offset += 4 + length
+                if comment[:len(key)].lower() == key:
+                    return comment[len(key):].decode('utf-8')
+            return None
+        if header[0] & 0x80:
+            return None
+        song_file.seek(size, 1)
+
+
+def _synchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _read_id3_song_id(song_file, header):
+    version, flags = header[3], header[5]
+    if version not in (3, 4) or flags & 0x80:
+        raise _UnsupportedTag()
+    end = 10 + _synchsafe(header[6:10])
+    position = 10
+    if flags & 0x40:
+        # Extended header, its v2.4 size counts itself
+        size_data = song_file.read(4)
+        position += _synchsafe(size_data) if version == 4 else int.from_bytes(size_data, 'big') + 4
+        song_file.seek(position)
+    while position + 10 <= end:
+        frame_header = song_file.read(10)
+        frame_id = frame_header[:4]
+        if len(frame_header) < 10 or frame_id[0] == 0:
+            # Padding
+            return None
+        if not frame_id.isalnum() or frame_id != frame_id.upper():
+            # Likely a v2.4 tag with v2.3 frame sizes
+            raise _UnsupportedTag()
+        size = _synchsafe(frame_header[4:8]) if version == 4 else int.from_bytes(frame_header[4:8], 'big')
+        position += 10 + size
+        if frame_id == b'TXXX':
+            # Grouped, compressed, encrypted or unsynchronised frame data
+            if frame_header[9] & (0x4F if version == 4 else 0xE0):
+                raise _UnsupportedTag()
+            description, value = _parse_txxx(song_file.read(size))
+            if description == SONG_ID_TAG:
+                return value
+        else:
+            song_file.seek(position)
+    return None
+
+
+def _parse_txxx(data):
+    """
+    :return: (description, first value) of a TXXX frame
+    """
+    encoding, body = data[0], data[1:]
+    if encoding in (0, 3):
+        codec = 'latin-1' if encoding == 0 else 'utf-8'
+        description, _, value = body.partition(b'\x00')
+    elif encoding in (1, 2):
+        # UTF-16 with a BOM per string, or big endian without
+        codec = 'utf-16' if encoding == 1 else 'utf-16-be'
+        end = 0
+        while end + 1 < len(body) and body[end:end + 2] != b'\x00\x00':
+            end += 2
+        description, value = body[:end], body[end + 2:]
+    else:
+        raise _UnsupportedTag()
+    return description.decode(codec), value.decode(codec).split('\x00')[0]
+
+
+def _read_song_id_mutagen(file_path):
+    from mutagen.flac import FLAC
+    from mutagen.id3 import ID3
+
+    extension = os.path.splitext(file_path)[1].lower()
+    try:
+        if extension == '.flac':
+            values = FLAC(file_path).get(SONG_ID_TAG.lower())
+        elif extension == '.mp3':
+            frame = ID3(file_path).get('TXXX:' + SONG_ID_TAG)
+            values = frame.text if frame else None
+        else:
+            return None
+    except Exception:
+        return None
+    return str(values[0]) if values else None
+
+
+def metadata_hash(song, is_program=False, metadata_hint=None):
+    """
+    Hash of the tags add_metadata_to_song would write, lyrics aside
+    """
+    meta = _build_metadata(song, is_program, None, metadata_hint)
+    data = json.dumps(meta, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
 
 
 def _build_metadata(song, is_program, lyrics, metadata_hint=None):
@@ -98,17 +252,7 @@ def _build_metadata(song, is_program, lyrics, metadata_hint=None):
 
     if not is_program:
         if disc_number is None or disc_total is None:
-            disc_raw = song.get('disc') or song.get('cd')
-            disc_number_from_song = None
-            disc_total_from_song = None
-            if isinstance(disc_raw, str):
-                parts = disc_raw.split('/')
-                if parts and parts[0].isdigit():
-                    disc_number_from_song = int(parts[0])
-                if len(parts) > 1 and parts[1].isdigit():
-                    disc_total_from_song = int(parts[1])
-            elif isinstance(disc_raw, int):
-                disc_number_from_song = disc_raw
+            disc_number_from_song, disc_total_from_song = song_disc(song)
             if disc_number is None:
                 disc_number = disc_number_from_song
             if disc_total is None:
@@ -163,55 +307,103 @@ def _build_metadata(song, is_program, lyrics, metadata_hint=None):
         'aliases': aliases,
         'comment': comment,
         'lyrics': lyric_text,
-        'translated_lyrics': translated_lyric
+        'translated_lyrics': translated_lyric,
+        'song_id': song.get('id')
     }
 
 
-def _guess_mime(cover_path):
-    lower_path = cover_path.lower()
-    if lower_path.endswith('.png'):
+def _guess_mime(cover_data):
+    if cover_data.startswith(b'\x89PNG'):
         return 'image/png'
     return 'image/jpeg'
 
 
-def _add_id3_metadata(file_path, cover_path, meta):
+def _tag_padding(info):
+    """
+    mutagen padding callback: keep the current padding when the new tags fit in
+    it, so retagging only rewrites the tag block instead of the whole file
+    """
+    if 0 <= info.padding <= TAG_MAX_PADDING:
+        return info.padding
+    return TAG_PADDING
+
+
+def _has_mpeg_frame(file_path):
+    """
+    Look for an MPEG audio frame sync right after the ID3v2 tag, if any, so e.g. an
+    error page saved as .mp3 isn't tagged; cheaper than parsing the file with mutagen.MP3
+    """
     try:
-        audio = MP3(file_path, ID3=ID3)
-    except HeaderNotFoundError:
+        with open(file_path, 'rb') as song_file:
+            header = song_file.read(10)
+            if len(header) == 10 and header[:3] == b'ID3':
+                # Tag size, plus the footer of a v2.4 tag
+                song_file.seek(10 + _synchsafe(header[6:10]) + (10 if header[5] & 0x10 else 0))
+            else:
+                song_file.seek(0)
+            data = song_file.read(MPEG_SYNC_WINDOW)
+    except IOError:
+        return False
+    position = data.find(b'\xff')
+    while position != -1 and position + 1 < len(data):
+        # 11 sync bits and a layer other than the reserved 00
+        if data[position + 1] & 0xE0 == 0xE0 and data[position + 1] & 0x06:
+            return True
+        position = data.find(b'\xff', position + 1)
+    return False
+
+
+def _add_id3_metadata(file_path, cover_data, meta):
+    from mutagen.id3 import (
+        ID3,
+        APIC,
+        COMM,
+        TCOM,
+        TCON,
+        TDRC,
+        TPE1,
+        TPE2,
+        TIT2,
+        TALB,
+        TPOS,
+        TRCK,
+        TXXX,
+        USLT,
+        ID3NoHeaderError,
+        error,
+    )
+
+    if not _has_mpeg_frame(file_path):
         print('Can\'t sync to MPEG frame, not an validate MP3 file!')
         return
 
-    if audio.tags is None:
-        print('No ID3 tag, trying to add one!')
-        try:
-            audio.add_tags()
-            audio.save()
-        except error as e:
-            print('Error occur when add tags:', str(e))
-            return
-
-    id3 = ID3(file_path)
+    # Only the tag is parsed, and the file is saved once
+    try:
+        id3 = ID3(file_path)
+    except ID3NoHeaderError:
+        id3 = ID3()
+    except error as e:
+        print('Error occur when read tags:', str(e))
+        return
 
     # Remove old frames we fully control
     for frame in ['APIC', 'TPE1', 'TPE2', 'TIT2', 'TALB', 'TRCK', 'TPOS', 'TCOM', 'TCON', 'TDRC', 'COMM', 'USLT']:
         if id3.getall(frame):
             id3.delall(frame)
-    for key in ['TXXX:ALIAS', 'TXXX:LYRIC_TRANSLATION']:
+    for key in ['TXXX:ALIAS', 'TXXX:LYRIC_TRANSLATION', 'TXXX:' + SONG_ID_TAG]:
         if key in id3:
             del id3[key]
 
     # Cover art
-    with open(cover_path, 'rb') as cover_file:
-        cover_data = cover_file.read()
-
-    id3.add(
-        APIC(
-            encoding=3,
-            mime=_guess_mime(cover_path),
-            type=3,  # front cover
-            data=cover_data
+    if cover_data:
+        id3.add(
+            APIC(
+                encoding=3,
+                mime=_guess_mime(cover_data),
+                type=3,  # front cover
+                data=cover_data
+            )
         )
-    )
 
     # Core fields
     if meta['artists']:
@@ -246,6 +438,8 @@ def _add_id3_metadata(file_path, cover_path, meta):
         id3.add(COMM(encoding=3, lang='eng', desc='', text=meta['comment']))
     if meta['aliases']:
         id3['TXXX:ALIAS'] = TXXX(encoding=3, desc='ALIAS', text=' / '.join(meta['aliases']))
+    if meta['song_id']:
+        id3['TXXX:' + SONG_ID_TAG] = TXXX(encoding=3, desc=SONG_ID_TAG, text=str(meta['song_id']))
 
     # Lyrics
     if meta['lyrics']:
@@ -253,10 +447,12 @@ def _add_id3_metadata(file_path, cover_path, meta):
     if meta['translated_lyrics']:
         id3['TXXX:LYRIC_TRANSLATION'] = TXXX(encoding=3, desc='LYRIC_TRANSLATION', text=meta['translated_lyrics'])
 
-    id3.save(v2_version=3)
+    id3.save(file_path, v2_version=3, padding=_tag_padding)
+
 
+def _add_flac_metadata(file_path, cover_data, meta):
+    from mutagen.flac import FLAC, Picture
 
-def _add_flac_metadata(file_path, cover_path, meta):
     try:
         audio = FLAC(file_path)
     except Exception:
@@ -299,6 +495,8 @@ def _add_flac_metadata(file_path, cover_path, meta):
         audio['comment'] = [meta['comment']]
     if meta['aliases']:
         audio['alias'] = meta['aliases']
+    if meta['song_id']:
+        audio[SONG_ID_TAG.lower()] = [str(meta['song_id'])]
 
     # Lyrics
     if meta['lyrics']:
@@ -307,12 +505,12 @@ def _add_flac_metadata(file_path, cover_path, meta):
         audio['lyrics-translation'] = [meta['translated_lyrics']]
 
     # Cover art
-    picture = Picture()
-    picture.type = 3
-    picture.desc = 'Cover'
-    picture.mime = _guess_mime(cover_path)
-    with open(cover_path, 'rb') as img_file:
-        picture.data = img_file.read()
-    audio.add_picture(picture)
-
-    audio.save()
+    if cover_data:
+        picture = Picture()
+        picture.type = 3
+        picture.desc = 'Cover'
+        picture.mime = _guess_mime(cover_data)
+        picture.data = cover_data
+        audio.add_picture(picture)
+
+    audio.save(padding=_tag_padding)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ncm import config
+from ncm.file_util import read_song_id
+
+# Extensions read_song_id understands
+LIBRARY_EXTENSIONS = ('.flac', '.mp3')
+
+# Files per tag reading task
+_READ_CHUNK_SIZE = 64
+
+
+def _read_song_ids(files):
+    """
+    :param files: list of (path, mtime_ns, size)
+    :return: list of (path, mtime_ns, size, song id or None)
+    """
+    return [(path, mtime, size, read_song_id(path)) for path, mtime, size in files]
+
+
+class LibraryIndex(object):
+    """
+    NetEase song ids of the audio files under the download folders, read from
+    their id tags and kept in SQLite. A rescan only reads the tags of files whose
+    mtime or size changed, so songs are found whatever their name or folder.
+    """
+
+    def __init__(self, path, workers=8, rescan_interval=0):
+        """
+        :param rescan_interval: seconds after a scan during which ensure_scanned doesn't scan again
+        """
+        super().__init__()
+        self.path = path
+        self.workers = max(1, workers)
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._scanned = set()
+        import sqlite3
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                           'path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL, song_id INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_song_id ON files (song_id)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS scans (root TEXT PRIMARY KEY, scanned_at REAL NOT NULL)')
+
+    def scan(self, root):
+        """
+        Index the audio files under root, reading the tags of new and changed files
+        in parallel and forgetting the files gone since the last scan
+        :return: (files under root, files read, files removed)
+        """
+        root = os.path.abspath(root)
+        # Every path under root sorts between root + sep and root + the next character
+        low, high = root + os.sep, root + chr(ord(os.sep) + 1)
+        with self._lock:
+            known = {path: (mtime, size) for path, mtime, size in self._conn.execute(
+                'SELECT path, mtime, size FROM files WHERE path > ? AND path < ?', (low, high))}
+        seen = set()
+        changed = []
+        for path, mtime, size in _walk_audio_files(root):
+            seen.add(path)
+            if known.get(path) != (mtime, size):
+                changed.append((path, mtime, size))
+        removed = [(path,) for path in known if path not in seen]
+
+        rows = []
+        if changed:
+            with ThreadPoolExecutor(self.workers) as executor:
+                chunks = [changed[i:i + _READ_CHUNK_SIZE] for i in range(0, len(changed), _READ_CHUNK_SIZE)]
+                for chunk_rows in executor.map(_read_song_ids, chunks):
+                    rows.extend(chunk_rows)
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', rows)
+            self._conn.executemany('DELETE FROM files WHERE path = ?', removed)
+            self._conn.execute('INSERT OR REPLACE INTO scans VALUES (?, ?)', (root, time.time()))
+            self._conn.execute('COMMIT')
+            self._scanned.add(root)
+        return len(seen), len(rows), len(removed)
+
+    def ensure_scanned(self, root):
+        """
+        Scan root once per process unless a scan finished less than rescan_interval
+        seconds ago, later downloads are added as they finish
+        """
+        root = os.path.abspath(root)
+        with self._scan_lock:
+            with self._lock:
+                if root in self._scanned:
+                    return
+                row = self._conn.execute('SELECT scanned_at FROM scans WHERE root = ?', (root,)).fetchone()
+                if row is not None and 0 <= time.time() - row[0] < self.rescan_interval:
+                    self._scanned.add(root)
+                    return
+            if not os.path.isdir(root):
+                return
+            begin = time.monotonic()
+            count, read, removed = self.scan(root)
+            if read or removed:
+                print('Library index: {} files, {} read, {} removed in {:.1f}s'.format(
+                    count, read, removed, time.monotonic() - begin))
+
+    def find(self, song_id):
+        """
+        :return: path of an indexed file of the song that is unchanged on disk, None if there is none
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT path, mtime, size FROM files WHERE song_id = ?', (song_id,)).fetchall()
+        for path, mtime, size in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_mtime_ns, stat.st_size) == (mtime, size):
+                return path
+        return None
+
+    def add(self, file_path, song_id):
+        """
+        Index a file just written with the id tag of song_id
+        """
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                               (file_path, stat.st_mtime_ns, stat.st_size, song_id))
+
+    def stats(self):
+        """
+        :return: (file count, files with a song id)
+        """
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*), COUNT(song_id) FROM files').fetchone()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _walk_audio_files(root):
+    """
+    :return: generator of (path, mtime_ns, size) of the audio files under root, hidden folders aside
+    """
+    folders = [root]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            folders.append(entry.path)
+                    elif entry.name.lower().endswith(LIBRARY_EXTENSIONS):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            # Removed while scanning
+                            continue
+                        yield entry.path, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            continue
+
+
+_library_index = None
+_library_index_lock = threading.Lock()
+
+
+def get_library_index():
+    """
+    Get the process-wide library index, None when disabled in config
+    """
+    global _library_index
+    if not config.LIBRARY_ENABLED:
+        return None
+    with _library_index_lock:
+        if _library_index is None:
+            os.makedirs(os.path.dirname(config.LIBRARY_INDEX_PATH), exist_ok=True)
+            _library_index = LibraryIndex(config.LIBRARY_INDEX_PATH, config.LIBRARY_SCAN_WORKERS,
+                                          config.LIBRARY_RESCAN_INTERVAL)
+        return _library_index
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from ncm import config
+from ncm.exceptions import NcmError
+
+
+class LyricStore(object):
+    """
+    Raw and translated lyrics of songs kept zlib compressed in SQLite, keyed by
+    song id. Songs without lyrics are stored too, so they are not asked again.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        import sqlite3
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS lyrics ('
+                           'song_id INTEGER PRIMARY KEY, data BLOB NOT NULL, fetched REAL NOT NULL)')
+
+    def get(self, song_id):
+        """
+        :return: dict with keys 'lyric' and 'tlyric', None if the song is not stored
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM lyrics WHERE song_id = ?', (song_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def has(self, song_id):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM lyrics WHERE song_id = ?', (song_id,)).fetchone() is not None
+
+    def set(self, song_id, lyrics):
+        data = zlib.compress(json.dumps(lyrics, ensure_ascii=False).encode('utf-8'))
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?)', (song_id, data, time.time()))
+
+    def clear(self):
+        """
+        :return: number of removed songs
+        """
+        with self._lock:
+            return self._conn.execute('DELETE FROM lyrics').rowcount
+
+    def stats(self):
+        """
+        :return: (song count, compressed bytes)
+        """
+        with self._lock:
+            count, size = self._conn.execute('SELECT COUNT(*), SUM(LENGTH(data)) FROM lyrics').fetchone()
+        return count, size or 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LyricFetcher(object):
+    """
+    Get lyrics from the lyric store, or from the api and store them. Lyrics of
+    the prefetched songs are requested in the background in song order, so they
+    are usually there by the time a track has been downloaded.
+    """
+
+    def __init__(self, api, store=None, prefetch_ids=(), workers=None):
+        super().__init__()
+        self.api = api
+        self.store = store
+        self.workers = config.LYRIC_PREFETCH_WORKERS if workers is None else workers
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.prefetch(prefetch_ids)
+
+    def prefetch(self, song_ids):
+        """
+        Request the lyrics of songs in the background, skipping those already stored
+        """
+        song_ids = [song_id for song_id in song_ids if self.store is None or not self.store.has(song_id)]
+        if not song_ids:
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max(1, self.workers))
+            for song_id in song_ids:
+                if song_id not in self._futures:
+                    self._futures[song_id] = self._executor.submit(self._fetch, song_id)
+
+    def discard(self, song_id):
+        """
+        Forget the prefetch of a song that won't be tagged, cancelling it if not started yet
+        """
+        with self._lock:
+            future = self._futures.pop(song_id, None)
+        if future is not None:
+            future.cancel()
+
+    def get(self, song_id):
+        """
+        :return: dict with keys 'lyric' and 'tlyric', None if they couldn't be fetched
+        """
+        with self._lock:
+            future = self._futures.pop(song_id, None)
+        if future is not None and not future.cancelled():
+            return future.result()
+        if self.store is not None:
+            lyrics = self.store.get(song_id)
+            if lyrics is not None:
+                return lyrics
+        return self._fetch(song_id)
+
+    def _fetch(self, song_id):
+        try:
+            lyrics = self.api.get_song_lyrics(song_id)
+        except NcmError as e:
+            print('Lyrics not available for {}: {}'.format(song_id, e))
+            return None
+        if self.store is not None:
+            self.store.set(song_id, lyrics)
+        return lyrics
+
+    def close(self):
+        """
+        Drop the prefetches not started yet, e.g. when the download was interrupted
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_lyric_store = None
+_lyric_store_lock = threading.Lock()
+
+
+def get_lyric_store():
+    """
+    Get the process-wide lyric store, None when the cache is disabled in config
+    """
+    global _lyric_store
+    if not config.CACHE_ENABLED:
+        return None
+    with _lyric_store_lock:
+        if _lyric_store is None:
+            os.makedirs(os.path.dirname(config.LYRIC_STORE_PATH), exist_ok=True)
+            _lyric_store = LyricStore(config.LYRIC_STORE_PATH)
+        return _lyric_store
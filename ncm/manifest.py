@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+
+MANIFEST_FILE_NAME = '.ncm-manifest.json'
+MANIFEST_VERSION = 1
+
+
+class Manifest(object):
+    """
+    Record of the songs downloaded into a folder: song id => relative file path,
+    size after tagging, requested quality and a hash of the written tags
+    """
+
+    def __init__(self, folder):
+        super().__init__()
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE_NAME)
+        self._lock = threading.Lock()
+        self.tracks = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as manifest_file:
+                    data = json.load(manifest_file)
+                if data.get('version') == MANIFEST_VERSION:
+                    self.tracks = {int(song_id): entry for song_id, entry in data.get('tracks', {}).items()}
+            except (IOError, ValueError):
+                print('Ignore broken manifest:', self.path)
+
+    def get(self, song_id):
+        with self._lock:
+            return self.tracks.get(song_id)
+
+    def record(self, song_id, file_path, quality, tag_hash):
+        with self._lock:
+            self.tracks[song_id] = {
+                'path': os.path.relpath(file_path, self.folder),
+                'size': os.path.getsize(file_path),
+                'quality': quality,
+                'tag_hash': tag_hash
+            }
+
+    def remove(self, song_id):
+        with self._lock:
+            self.tracks.pop(song_id, None)
+
+    def owns(self, file_path):
+        """
+        Whether file_path is inside the manifest folder
+        """
+        return os.path.abspath(file_path).startswith(os.path.abspath(self.folder) + os.sep)
+
+    def file_path(self, entry):
+        return os.path.join(self.folder, entry['path'])
+
+    def is_intact(self, entry):
+        """
+        Whether the recorded file is still on disk, untouched since it was recorded
+        """
+        try:
+            return os.path.getsize(self.file_path(entry)) == entry['size']
+        except OSError:
+            return False
+
+    def save(self):
+        with self._lock:
+            data = {
+                'version': MANIFEST_VERSION,
+                'tracks': {str(song_id): entry for song_id, entry in self.tracks.items()}
+            }
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(data, manifest_file, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+
+from ncm.pool import TrackResult
+
+
+class Stage(object):
+    """
+    A pipeline step run by its own worker threads, fed by a bounded queue
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=4):
+        """
+        :param func: takes a job and returns it, setting job.status takes the job out of the pipeline
+        """
+        super().__init__()
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.processed = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+
+    def record(self, busy_time, wait_time):
+        with self._lock:
+            self.processed += 1
+            self.busy_time += busy_time
+            self.wait_time += wait_time
+
+
+class Pipeline(object):
+    """
+    Run jobs through stages connected by bounded queues, so the stages of
+    different jobs overlap, e.g. tagging a track while the next one downloads.
+    A full queue blocks the stage before it, which in turn stops reading tasks.
+    """
+
+    def __init__(self, stages):
+        """
+        :param stages: list of Stage, the first one gets the task values
+        """
+        super().__init__()
+        self.stages = stages
+        self._done = queue.Queue()
+
+    def run(self, tasks):
+        """
+        :param tasks: iterable of (name, value), consumed lazily as the first stage has room
+        :return: list of TrackResult in the same order as tasks
+        """
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(i,), daemon=True)
+                thread.start()
+                threads.append(thread)
+        feed_state = {'count': 0, 'error': None}
+        feeder = threading.Thread(target=self._feed, args=(tasks, feed_state), daemon=True)
+        feeder.start()
+
+        results = {}
+        feeding = True
+        while feeding or len(results) < feed_state['count']:
+            result = self._done.get()
+            if result is None:
+                feeding = False
+                continue
+            print('{}: {} [{}]'.format(result.index + 1, result.name, result.status))
+            results[result.index] = result
+
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                stage.put(None)
+        for thread in threads:
+            thread.join()
+        if feed_state['error'] is not None:
+            raise feed_state['error']
+        return [results[i] for i in sorted(results)]
+
+    def _feed(self, tasks, feed_state):
+        try:
+            for index, (name, value) in enumerate(tasks):
+                self.stages[0].put((index, name, value, time.monotonic()))
+                feed_state['count'] = index + 1
+        except Exception as e:
+            feed_state['error'] = e
+        finally:
+            self._done.put(None)
+
+    def _work(self, stage_index):
+        stage = self.stages[stage_index]
+        next_stage = self.stages[stage_index + 1] if stage_index + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is None:
+                return
+            index, name, job, queued_at = item
+            started_at = time.monotonic()
+            try:
+                job = stage.func(job)
+            except Exception as e:
+                self._done.put(TrackResult(index, name, 'failed', '{}: {}'.format(e.__class__.__name__, e)))
+                continue
+            finally:
+                stage.record(time.monotonic() - started_at, started_at - queued_at)
+            if job.status is not None or next_stage is None:
+                self._done.put(TrackResult(index, name, job.status))
+            else:
+                next_stage.put((index, name, job, time.monotonic()))
+
+    def stats(self):
+        """
+        :return: list of (stage name, workers, jobs processed, busy seconds, seconds waited in queue,
+                 max queue depth, current queue depth)
+        """
+        return [(stage.name, stage.workers, stage.processed, stage.busy_time, stage.wait_time,
+                 stage.max_depth, stage.queue.qsize()) for stage in self.stages]
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from ncm import config
+
+
+class TrackResult(object):
+
+    def __init__(self, index, name, status, detail=None):
+        super().__init__()
+        self.index = index
+        self.name = name
+        self.status = status
+        self.detail = detail
+
+
+class HostLimiter(object):
+    """
+    Bound the number of requests in flight against a single host
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _get_semaphore(self, host):
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.limit)
+                self._semaphores[host] = semaphore
+            return semaphore
+
+    @contextmanager
+    def acquire(self, url):
+        semaphore = self._get_semaphore(urlparse(url).netloc)
+        with semaphore:
+            yield
+
+
+_host_limiter = None
+_host_limiter_lock = threading.Lock()
+
+
+def get_host_limiter():
+    global _host_limiter
+    with _host_limiter_lock:
+        if _host_limiter is None:
+            _host_limiter = HostLimiter(max(1, config.DOWNLOAD_HOST_LIMIT))
+        return _host_limiter
+
+
+class CpuPool(object):
+    """
+    Run CPU bound work, cover resizing and tag writing, away from the download
+    threads: on worker processes so it doesn't hold their GIL, or on a thread
+    pool. At most backlog calls are queued or running, callers block beyond that.
+    """
+
+    def __init__(self, workers, processes=True, backlog=None):
+        super().__init__()
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(backlog or workers * 2)
+        if processes:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # Forking a process full of download threads can copy held locks, start clean instead
+            self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = ThreadPoolExecutor(workers)
+
+    def run(self, func, *args):
+        """
+        Call func(*args) on the pool and wait for it, func and args must be picklable for processes
+        :return: the result of func, its exception is raised again here
+        """
+        with self._slots:
+            return self._executor.submit(func, *args).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class _InlinePool(object):
+    """
+    CpuPool stand-in calling func in the current thread
+    """
+
+    def run(self, func, *args):
+        return func(*args)
+
+    def shutdown(self):
+        pass
+
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+# Worker processes are only used once allow_cpu_processes was called
+_processes_allowed = False
+
+
+def allow_cpu_processes():
+    """
+    Let the cpu pool start worker processes when cpu.processes is set. Spawned
+    workers import the __main__ module again, so only an entry point guarding it
+    with if __name__ == '__main__' may call this, library callers get threads.
+    """
+    global _processes_allowed
+    _processes_allowed = True
+
+
+def get_cpu_pool():
+    """
+    Get the process-wide pool for CPU bound work configured by the cpu.* settings
+    """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            if config.CPU_WORKERS > 0:
+                _cpu_pool = CpuPool(config.CPU_WORKERS, config.CPU_PROCESSES and _processes_allowed)
+            else:
+                _cpu_pool = _InlinePool()
+        return _cpu_pool
+
+
+def report_results(results):
+    """
+    Print a per-track summary in track order
+    :param results: list of TrackResult
+    :return:
+    """
+    if not results:
+        return
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+        if result.status not in ('downloaded', 'skipped', 'retagged'):
+            line = '{:>4}: {} [{}]'.format(result.index + 1, result.name, result.status)
+            if result.detail:
+                line += ' {}'.format(result.detail)
+            print(line)
+    print('Done: ' + ', '.join('{} {}'.format(counts[k], k) for k in sorted(counts)))
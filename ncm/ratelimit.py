@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from ncm import config
+
+# Endpoint classes with their own request budget
+ENDPOINT_DETAIL = 'detail'
+ENDPOINT_URL = 'url'
+ENDPOINT_LYRIC = 'lyric'
+ENDPOINT_CDN = 'cdn'
+
+# Http status codes telling us to slow down, besides the api's own code 406
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+class TokenBucket(object):
+    """
+    Allow rate requests per second on average and up to burst at once. The rate
+    is halved whenever the server pushes back and creeps back up to the configured
+    rate on every successful request.
+    """
+
+    def __init__(self, rate, burst, min_rate=0.05):
+        super().__init__()
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min(min_rate, rate) if rate else 0
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token
+        :return: seconds to wait before the request may be sent
+        """
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def penalize(self):
+        if not self.rate:
+            return
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Drop the saved up burst as well
+            self._tokens = min(self._tokens, 0)
+
+    def reward(self):
+        if not self.rate or self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter(object):
+    """
+    One token bucket per endpoint class
+    """
+
+    def __init__(self, limits):
+        """
+        :param limits: dict of endpoint class => (requests per second, burst), 0 rate for no limit
+        """
+        super().__init__()
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in limits.items()}
+
+    def get_bucket(self, kind):
+        return self.buckets[kind]
+
+    def acquire(self, kind):
+        self.buckets[kind].acquire()
+
+    def reserve(self, kind):
+        return self.buckets[kind].reserve()
+
+    def report(self, kind, throttled):
+        """
+        Adapt the rate of an endpoint class to the outcome of a request
+        :param throttled: the server answered 406, 429 or 503
+        """
+        bucket = self.buckets[kind]
+        if throttled:
+            bucket.penalize()
+            print('Server is busy, slow down {} requests to {:.2f}/s'.format(kind, bucket.rate))
+        else:
+            bucket.reward()
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Get the process-wide rate limiter configured by the ratelimit.* settings
+    """
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(config.RATE_LIMITS)
+        return _rate_limiter
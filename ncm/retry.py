@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+from ncm import config
+from ncm.exceptions import CircuitOpenError
+
+# Consecutive failures opening a breaker, and seconds it stays open
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 60
+# Seconds to wait for the result of a running trial request
+BREAKER_TRIAL_WAIT = 1
+# Pauses in a row after which requests stop waiting for the endpoint class
+BREAKER_MAX_WAIT_OPENINGS = 3
+
+
+class RetryPolicy(object):
+    """
+    Bounded attempts with exponential backoff and full jitter
+    """
+
+    def __init__(self, max_attempts=None, base_delay=1, max_delay=None):
+        super().__init__()
+        self.max_attempts = max(1, config.RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = config.RETRY_MAX_DELAY if max_delay is None else max_delay
+
+    def should_retry(self, attempt):
+        """
+        :param attempt: number of attempts made so far
+        """
+        return attempt < self.max_attempts
+
+    def backoff(self, attempt):
+        """
+        :param attempt: number of attempts made so far
+        :return: seconds to wait before the next attempt
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """
+    Refuse requests for reset_timeout seconds after failure_threshold consecutive
+    failures, then let one trial request through to decide whether to close again
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 max_wait_openings=BREAKER_MAX_WAIT_OPENINGS):
+        super().__init__()
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait_openings = max_wait_openings
+        self._failures = 0
+        # Times opened since the last success
+        self._openings = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Callers must report the outcome with record_success or record_failure, a
+        half open breaker refuses other requests until the trial request did
+        :raise CircuitOpenError: when the breaker is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise CircuitOpenError(self.name, remaining if remaining > 0 else BREAKER_TRIAL_WAIT)
+            # Half open, this request decides
+            self._trial_running = True
+
+    def worth_waiting(self):
+        """
+        Whether callers should wait for the breaker to close rather than fail. Once
+        the trial requests kept failing, waiting would only stall every request by
+        a pause; the breaker still lets a trial through after each pause.
+        """
+        with self._lock:
+            return self._openings < self.max_wait_openings
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._openings = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            tripped = self._opened_at is None and self._failures >= self.failure_threshold
+            if tripped or self._trial_running:
+                print('Too many failed {} requests, pause them for {} seconds'.format(self.name, self.reset_timeout))
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+                self._openings += 1
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint):
+    """
+    Get the process-wide circuit breaker of an endpoint class
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint)
+            _breakers[endpoint] = breaker
+        return breaker
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from ncm import config
+from ncm.constants import user_agent
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(pool_size=None, retries=None, keep_alive=None):
+    """
+    Create a connection-pooled session, unset options fall back to config
+    :param pool_size: connections kept per host
+    :param retries: retries of GET requests on connection errors and 500, 502, 504 responses
+    :param keep_alive: reuse connections between requests
+    :return: requests.Session
+    """
+    # requests takes longer to import than the rest of ncm, only load it once a request is made
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    pool_size = config.HTTP_POOL_SIZE if pool_size is None else pool_size
+    retries = config.HTTP_RETRIES if retries is None else retries
+    keep_alive = config.HTTP_KEEP_ALIVE if keep_alive is None else keep_alive
+    # Requests to one host are bounded by the host limiter, never need more connections than that
+    pool_size = max(pool_size, config.DOWNLOAD_HOST_LIMIT)
+
+    # Busy answers (429, 503) and api POSTs are retried with the retry policy by the
+    # api client and the cdn downloads, which also feed the rate limiter; retrying
+    # them here too would multiply the attempts
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 504),
+                  allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'User-Agent': user_agent})
+    if not keep_alive:
+        session.headers.update({'Connection': 'close'})
+    return session
+
+
+def get_session():
+    """
+    Get the process-wide session shared by api calls and file downloads
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
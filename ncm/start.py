@@ -1,153 +1,257 @@
 # -*- coding: utf-8 -*-
 import argparse
+import itertools
 import os
+import time
 
 from urllib.parse import urlparse, parse_qs
 from ncm import config
-from ncm.api import CloudApi
-from ncm.downloader import get_song_info_by_id
+from ncm.album import get_album_indexes
+from ncm.album import song_disc
+from ncm.api import get_api
 from ncm.downloader import download_song_by_id
+from ncm.downloader import create_track_pipeline
 from ncm.downloader import download_song_by_song
 from ncm.downloader import format_string
-from ncm.constants import get_headers
+from ncm.downloader import get_bitrate_from_quality
+from ncm.downloader import get_song_info_by_id
+from ncm.downloader import prepare_retag
+from ncm.downloader import prepare_song
+from ncm.downloader import SongUrlResolver
+from ncm.downloader import STATUS_SKIPPED
+from ncm.file_util import metadata_hash
+from ncm.manifest import Manifest
+from ncm.cache import CACHE_TTL
+from ncm.cache import get_cache
+from ncm.library import get_library_index
+from ncm.lyrics import LyricFetcher
+from ncm.lyrics import get_lyric_store
+from ncm.exceptions import NcmError
+from ncm.session import get_session
+from ncm.pool import allow_cpu_processes
+from ncm.pool import report_results
 
-# load the config first
-config.load_config()
-api = CloudApi(user_cookie=config.USER_COOKIE)
+# Print per-stage pipeline stats after a download, set by --stats
+show_stats = False
 
 
-def _parse_disc_number(disc_raw):
-    if isinstance(disc_raw, str):
-        parts = disc_raw.split('/')
-        if parts and parts[0].isdigit():
-            return int(parts[0])
-    elif isinstance(disc_raw, int):
-        return disc_raw
-    return None
+def _build_url_resolver(songs):
+    bit_rate = get_bitrate_from_quality(config.AUDIO_QUALITY)
+    return SongUrlResolver(get_api(), [song['id'] for song in songs], bit_rate)
 
 
-def _build_disc_map(songs):
-    """Return (disc_track_count, disc_total, disc_track_number)."""
-    disc_track_count = {}
-    disc_total = None
-    disc_track_number = {}
-    disc_running_index = {}
-    for song in songs:
-        disc_raw = song.get('disc') or song.get('cd')
-        disc_num = _parse_disc_number(disc_raw)
-        disc_total_from_song = None
-        if isinstance(disc_raw, str):
-            parts = disc_raw.split('/')
-            if len(parts) > 1 and parts[1].isdigit():
-                disc_total_from_song = int(parts[1])
-        if disc_num:
-            disc_track_count[disc_num] = disc_track_count.get(disc_num, 0) + 1
-            disc_running_index[disc_num] = disc_running_index.get(disc_num, 0) + 1
-            disc_track_number[song.get('id')] = disc_running_index[disc_num]
-        if disc_total is None and disc_total_from_song:
-            disc_total = disc_total_from_song
-    if disc_total is None and disc_track_count:
-        disc_total = max(disc_track_count.keys())
-    return disc_track_count, disc_total, disc_track_number
-
-
-def _find_disc_from_album_songs(album_songs, song_id):
-    for s in album_songs:
-        if s.get('id') == song_id:
-            return _parse_disc_number(s.get('disc') or s.get('cd'))
-    return None
+def _build_lyric_fetcher():
+    # Lyrics are prefetched by prepare_song, once a song turns out not to be downloaded yet
+    return LyricFetcher(get_api(), get_lyric_store())
+
+
+def _download_tracks(tasks, lyric_fetcher=None):
+    """
+    :param tasks: iterable of (name, callable returning a TrackJob)
+    :param lyric_fetcher: prefetching the lyrics of the tasks, closed once they are done
+    """
+    pipeline = create_track_pipeline(config.DOWNLOAD_JOBS)
+    try:
+        report_results(pipeline.run(tasks))
+    finally:
+        if lyric_fetcher is not None:
+            lyric_fetcher.close()
+        if show_stats:
+            print_pipeline_stats(pipeline)
+
+
+def print_pipeline_stats(pipeline):
+    print('{:10} {:>7} {:>6} {:>9} {:>9} {:>9}'.format('stage', 'workers', 'tracks', 'busy(s)', 'waited(s)',
+                                                      'max queue'))
+    for name, workers, processed, busy_time, wait_time, max_depth, _ in pipeline.stats():
+        print('{:10} {:>7} {:>6} {:>9.2f} {:>9.2f} {:>9}'.format(name, workers, processed, busy_time, wait_time,
+                                                               max_depth))
 
 
 def download_hot_songs(artist_id):
-    songs = api.get_hot_songs(artist_id)
+    songs = get_api().get_hot_songs(artist_id)
     folder_name = format_string(songs[0]['artists'][0]['name']) + ' - hot50'
     folder_path = os.path.join(config.DOWNLOAD_DIR, folder_name)
     download_count = config.DOWNLOAD_HOT_MAX if (0 < config.DOWNLOAD_HOT_MAX < 50) else config.DOWNLOAD_HOT_MAX_DEFAULT
-    for i, song in zip(range(download_count), songs):
-        print('{}: {}'.format(i + 1, song['name']))
-        download_song_by_song(song, folder_path, False)
+    songs = songs[:download_count]
+    url_resolver = _build_url_resolver(songs)
+    lyric_fetcher = _build_lyric_fetcher()
+    tasks = []
+    for song in songs:
+        tasks.append((song['name'], lambda song=song: prepare_song(
+            song, folder_path, False, url_resolver=url_resolver, lyric_fetcher=lyric_fetcher)))
+    _download_tracks(tasks, lyric_fetcher)
 
 
 def download_album_songs(album_id):
-    songs = api.get_album_songs(album_id)
+    songs = get_api().get_album_songs(album_id)
     folder_name = format_string(songs[0]['album']['name']) + ' - album'
     folder_path = os.path.join(config.DOWNLOAD_DIR, folder_name)
-    disc_track_count, disc_total, disc_track_number = _build_disc_map(songs)
+    album_index = get_album_indexes().put(album_id, songs)
+    url_resolver = _build_url_resolver(songs)
+    lyric_fetcher = _build_lyric_fetcher()
 
-    for i, song in enumerate(songs):
-        disc_num = _parse_disc_number(song.get('disc') or song.get('cd'))
-        track_number = disc_track_number.get(song.get('id')) or song.get('no')
-        track_total = disc_track_count.get(disc_num) if disc_num else song.get('album', {}).get('size')
-        metadata_hint = {
-            'disc_number': disc_num,
-            'disc_total': disc_total,
-            'track_number': track_number,
-            'track_total': track_total
-        }
-
-        print('{}: {}'.format(i + 1, song['name']))
-        download_song_by_song(song, folder_path, False, metadata_hint=metadata_hint)
+    tasks = []
+    for song in songs:
+        metadata_hint = album_index.metadata_hint(song)
+        tasks.append((song['name'], lambda song=song, metadata_hint=metadata_hint: prepare_song(
+            song, folder_path, False, metadata_hint=metadata_hint, url_resolver=url_resolver,
+            lyric_fetcher=lyric_fetcher)))
+    _download_tracks(tasks, lyric_fetcher)
 
 
 def download_program(program_id):
-    program = api.get_program(program_id)
+    program = get_api().get_program(program_id)
     folder_name = format_string(program['dj']['brand']) + ' - program'
     folder_path = os.path.join(config.DOWNLOAD_DIR, folder_name)
     download_song_by_song(program, folder_path, False, True)
 
 
-def download_radio_programs(radio_id):
-    programs = api.get_radio_programs(radio_id)
-    if not programs:
+def download_radio_programs(radio_id, since=None, latest=None):
+    """
+    :param since: only programs published at or after this time, seconds since epoch
+    :param latest: only the newest N programs
+    """
+    programs = get_api().iter_radio_programs(radio_id, since=since, latest=latest)
+    first = next(programs, None)
+    if first is None:
         print('No programs found for radio id: {}'.format(radio_id))
         return
-    folder_name = format_string((programs[0].get('radio') or {}).get('name', 'unknown')) + ' - radio'
+    folder_name = format_string((first.get('radio') or {}).get('name', 'unknown')) + ' - radio'
     folder_path = os.path.join(config.DOWNLOAD_DIR, folder_name)
-    for i, program in enumerate(programs):
-        print('{}: {}'.format(i + 1, program['name']))
-        download_song_by_song(program, folder_path, False, True)
+    # Programs start downloading while the later pages are still being fetched
+    tasks = ((program['name'], lambda program=program: prepare_song(program, folder_path, False, True))
+             for program in itertools.chain([first], programs))
+    _download_tracks(tasks)
+
+
+def _playlist_metadata_hint(song_detail, album_indexes):
+    album_id = song_detail.get('album', {}).get('id')
+    if album_id:
+        return album_indexes.get(album_id).metadata_hint(song_detail)
+    return {
+        'disc_number': song_disc(song_detail)[0],
+        'disc_total': None,
+        'track_number': song_detail.get('no'),
+        'track_total': None
+    }
+
+
+def _prepare_playlist_song(song_detail, folder_path, album_indexes, url_resolver, lyric_fetcher, manifest, sync):
+    metadata_hint = _playlist_metadata_hint(song_detail, album_indexes)
+    entry = manifest.get(song_detail['id'])
+    redownload = sync and entry is not None and entry['quality'] != config.AUDIO_QUALITY
+    if redownload:
+        print('{} was downloaded as {}, downloading it again as {}'.format(
+            song_detail['name'], entry['quality'], config.AUDIO_QUALITY))
+        _remove_playlist_song(manifest, song_detail['id'])
+    elif sync and entry and manifest.is_intact(entry):
+        job = prepare_retag(song_detail, manifest.file_path(entry), metadata_hint=metadata_hint, manifest=manifest,
+                            lyric_fetcher=lyric_fetcher)
+        if entry['tag_hash'] == metadata_hash(song_detail, False, metadata_hint):
+            job.status = STATUS_SKIPPED
+        return job
+    return prepare_song(song_detail, folder_path, False, metadata_hint=metadata_hint,
+                        url_resolver=url_resolver, manifest=manifest, lyric_fetcher=lyric_fetcher,
+                        redownload=redownload)
+
+
+def _remove_playlist_song(manifest, song_id):
+    file_path = manifest.file_path(manifest.get(song_id))
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        print('Deleted', file_path)
+    manifest.remove(song_id)
 
 
-def download_playlist_songs(playlist_id):
-    songs, playlist_name = api.get_playlist_songs(playlist_id)
+def _prune_playlist_folder(manifest, song_ids, prune):
+    removed = [song_id for song_id in list(manifest.tracks) if song_id not in song_ids]
+    if not removed:
+        return
+    if not prune:
+        print('{} downloaded song(s) are no longer in the playlist, use --prune to delete them'.format(len(removed)))
+        return
+    for song_id in removed:
+        _remove_playlist_song(manifest, song_id)
+
+
+def _iter_playlist_tasks(song_ids, folder_path, manifest, sync, lyric_fetcher):
+    """
+    Fetch the song details of a playlist page by page while yielding its download
+    tasks, the next page is only requested once the pipeline has taken this one
+    """
+    album_indexes = get_album_indexes()
+    bit_rate = get_bitrate_from_quality(config.AUDIO_QUALITY)
+    url_resolver = SongUrlResolver(get_api(), song_ids, bit_rate)
+    available = 0
+    for songs in get_api().iter_songs(song_ids, config.PLAYLIST_PAGE_SIZE):
+        available += len(songs)
+        for song in songs:
+            yield song['name'], lambda song=song: _prepare_playlist_song(
+                song, folder_path, album_indexes, url_resolver, lyric_fetcher, manifest, sync)
+    if available < len(song_ids):
+        print('{} song(s) of the playlist are not available'.format(len(song_ids) - available))
+
+
+def download_playlist_songs(playlist_id, sync=False, prune=False):
+    track_ids, playlist_name = get_api().get_playlist_songs(playlist_id)
     folder_name = format_string(playlist_name) + ' - playlist'
     folder_path = os.path.join(config.DOWNLOAD_DIR, folder_name)
-    album_cache = {}
-    for i, song in enumerate(songs):
-        song_detail = get_song_info_by_id(song['id'])
-        album_id = song_detail.get('album', {}).get('id')
-        disc_num = _parse_disc_number(song_detail.get('disc') or song_detail.get('cd'))
-        track_total = None
-        disc_total = None
-
-        if album_id:
-            if album_id not in album_cache:
-                album_songs = api.get_album_songs(album_id)
-                disc_track_count, disc_total_val, disc_track_number = _build_disc_map(album_songs)
-                album_cache[album_id] = {
-                    'songs': album_songs,
-                    'disc_track_count': disc_track_count,
-                    'disc_total': disc_total_val,
-                    'disc_track_number': disc_track_number
-                }
-            album_info = album_cache[album_id]
-            if disc_num is None:
-                disc_num = _find_disc_from_album_songs(album_info['songs'], song_detail['id'])
-            track_total = album_info['disc_track_count'].get(disc_num) if disc_num else None
-            disc_total = album_info['disc_total']
-            track_number = album_info['disc_track_number'].get(song_detail['id']) or song_detail.get('no')
-        else:
-            track_number = song_detail.get('no')
-
-        metadata_hint = {
-            'disc_number': disc_num,
-            'disc_total': disc_total,
-            'track_number': track_number,
-            'track_total': track_total
-        }
-
-        print('{}: {}'.format(i + 1, song_detail['name']))
-        download_song_by_song(song_detail, folder_path, False, metadata_hint=metadata_hint)
+    song_ids = [track['id'] for track in track_ids]
+    manifest = Manifest(folder_path)
+    if sync:
+        _prune_playlist_folder(manifest, set(song_ids), prune)
+    lyric_fetcher = _build_lyric_fetcher()
+    try:
+        _download_tracks(_iter_playlist_tasks(song_ids, folder_path, manifest, sync, lyric_fetcher), lyric_fetcher)
+    finally:
+        manifest.save()
+
+
+def manage_cache(show_info, clear_kind):
+    cache = get_cache()
+    if cache is None:
+        print('Metadata cache is disabled')
+        return
+    lyric_store = get_lyric_store()
+    if clear_kind:
+        count = 0
+        if clear_kind != 'lyric':
+            count += cache.invalidate(None if clear_kind == 'all' else clear_kind)
+        if clear_kind in ('all', 'lyric'):
+            count += lyric_store.clear()
+        print('Removed {} cache entries'.format(count))
+    if show_info:
+        print('Cache file: {}'.format(cache.path))
+        for kind, count, size, expired in cache.stats():
+            print('{:10} {:6} entries, {:10.2f}KB, {} expired'.format(kind, count, size / 1024, expired))
+        count, size = lyric_store.stats()
+        print('Lyric file: {}'.format(lyric_store.path))
+        print('{:10} {:6} entries, {:10.2f}KB'.format('lyric', count, size / 1024))
+
+
+def scan_library():
+    library = get_library_index()
+    if library is None:
+        print('Library index is disabled')
+        return
+    begin = time.monotonic()
+    count, read, removed = library.scan(config.DOWNLOAD_DIR)
+    print('Scanned {} files under {} in {:.1f}s, {} read, {} removed'.format(
+        count, config.DOWNLOAD_DIR, time.monotonic() - begin, read, removed))
+    total, with_id = library.stats()
+    print('Library index: {} files, {} with a song id'.format(total, with_id))
+
+
+def parse_date(value):
+    """
+    :param value: YYYY-MM-DD in local time
+    :return: seconds since epoch
+    """
+    try:
+        return time.mktime(time.strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a date as YYYY-MM-DD, got {!r}'.format(value))
 
 
 def get_parse_id(song_id):
@@ -176,29 +280,68 @@ def main():
                         help='Download a playlist all songs by playlist_id')
     parser.add_argument('-ua', metavar='user_agent', dest='user_agent',
                         help='Specify the User-Agent to be used when downloading')
+    parser.add_argument('-j', metavar='jobs', dest='jobs', type=int,
+                        help='Download N tracks in parallel for -ss/-hot/-a/-p/-radio')
+    parser.add_argument('--sync', dest='sync', action='store_true',
+                        help='With -p, only download new songs and retag changed ones')
+    parser.add_argument('--prune', dest='prune', action='store_true',
+                        help='With -p --sync, delete songs no longer in the playlist')
+    parser.add_argument('--since', metavar='date', dest='since', type=parse_date,
+                        help='With -radio, only download programs published on or after YYYY-MM-DD')
+    parser.add_argument('--latest', metavar='N', dest='latest', type=int,
+                        help='With -radio, only download the newest N programs')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='Show per-stage worker, timing and queue stats after downloading')
+    parser.add_argument('--library-scan', dest='library_scan', action='store_true',
+                        help='Rescan the download folder into the library index of downloaded song ids')
+    parser.add_argument('--cache-info', dest='cache_info', action='store_true',
+                        help='Show the local metadata cache entries')
+    parser.add_argument('--cache-clear', metavar='type', dest='cache_clear', nargs='?', const='all',
+                        choices=['all'] + sorted(CACHE_TTL) + ['lyric'],
+                        help='Clear the local metadata cache, all entries or only one type')
     args = parser.parse_args()
+    config.load_config()
+    if args.cache_info or args.cache_clear:
+        manage_cache(args.cache_info, args.cache_clear)
+        return
+    if args.library_scan:
+        scan_library()
+        return
+    if args.stats:
+        global show_stats
+        show_stats = True
+    if args.jobs is not None:
+        config.DOWNLOAD_JOBS = max(1, args.jobs)
     if args.user_agent:
-        # Update global api with custom user agent
-        custom_headers = get_headers(config.USER_COOKIE)
-        custom_headers.update({'User-Agent': args.user_agent})
-        global api
-        api = CloudApi(user_cookie=config.USER_COOKIE)
-        api.session.headers.update({'User-Agent': args.user_agent})
-    if args.song_id:
-        download_song_by_id(get_parse_id(args.song_id), config.DOWNLOAD_DIR)
-    elif args.song_ids:
-        for song_id in args.song_ids:
-            download_song_by_id(get_parse_id(song_id), config.DOWNLOAD_DIR)
-    elif args.artist_id:
-        download_hot_songs(get_parse_id(args.artist_id))
-    elif args.album_id:
-        download_album_songs(get_parse_id(args.album_id))
-    elif args.playlist_id:
-        download_playlist_songs(get_parse_id(args.playlist_id))
-    elif args.program_id:
-        download_program(get_parse_id(args.program_id))
-    elif args.radio_id:
-        download_radio_programs(get_parse_id(args.radio_id))
+        # Api requests send their own headers, cdn downloads use the session ones
+        get_api().headers['User-Agent'] = args.user_agent
+        get_session().headers['User-Agent'] = args.user_agent
+    if not (args.song_id or args.program_id):
+        # Multi-track runs, worth starting worker processes for
+        allow_cpu_processes()
+    try:
+        if args.song_id:
+            download_song_by_id(get_parse_id(args.song_id), config.DOWNLOAD_DIR)
+        elif args.song_ids:
+            song_ids = [get_parse_id(song_id) for song_id in args.song_ids]
+            lyric_fetcher = _build_lyric_fetcher()
+            tasks = []
+            for song_id in song_ids:
+                tasks.append((song_id, lambda song_id=song_id: prepare_song(
+                    get_song_info_by_id(song_id), config.DOWNLOAD_DIR, lyric_fetcher=lyric_fetcher)))
+            _download_tracks(tasks, lyric_fetcher)
+        elif args.artist_id:
+            download_hot_songs(get_parse_id(args.artist_id))
+        elif args.album_id:
+            download_album_songs(get_parse_id(args.album_id))
+        elif args.playlist_id:
+            download_playlist_songs(get_parse_id(args.playlist_id), sync=args.sync, prune=args.prune)
+        elif args.program_id:
+            download_program(get_parse_id(args.program_id))
+        elif args.radio_id:
+            download_radio_programs(get_parse_id(args.radio_id), since=args.since, latest=args.latest)
+    except NcmError as e:
+        print(e)
 
 
 if __name__ == '__main__':